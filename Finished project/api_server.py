@@ -0,0 +1,402 @@
+"""JSON HTTP API in front of MovieApp for many users in one process.
+
+    python api_server.py --port 8080
+
+Requests authenticate with HTTP basic auth (UserShell registry), the
+backend is chosen with ?backend=json|journal|csv|sqlite|mmap (default json).
+
+    POST   /users                  {"username": ..., "password": ...}
+    GET    /movies?offset=0&limit=50
+    POST   /movies                 {"title": ...}
+    PATCH  /movies/<title>         {"rating": ...}
+    DELETE /movies/<title>
+    GET    /movies/sorted?order=desc&limit=20
+    GET    /stats
+    POST   /webpage
+
+"sorted" is reserved, it is never read as a title. Open storages are kept
+in a bounded LRU cache and closed once evicted and idle. Per user file,
+reads run concurrently and writes one at a time. File work runs in a
+small thread pool, OMDb lookups and poster downloads in a bigger one, so
+the event loop never blocks."""
+import argparse
+import asyncio
+import base64
+import binascii
+import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from urllib.parse import parse_qs, unquote, urlsplit
+import movies_storage as webCalls
+from movies_storage import FunctionErrors
+from movie_user_app import (MovieApp, UserShell, UserShellError, AppError,
+                            get_user_storage)
+from poster_cache import get_poster_cache
+from storage import StorageError, MovieExistsError, MovieNotFoundError
+
+MAX_BODY = 1024 * 1024
+STATUS_TEXT = {200: "OK", 201: "Created", 400: "Bad Request", 401: "Unauthorized",
+               404: "Not Found", 405: "Method Not Allowed", 409: "Conflict",
+               413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class ApiError(Exception):
+    """ApiError carries the HTTP status of a failed request."""
+
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class ReadWriteLock:
+    """asyncio lock letting many readers or a single writer in. Waiting
+    writers go before new readers so writes aren't starved."""
+
+    def __init__(self):
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire_read(self):
+        """Waits until no writer holds or waits for the lock."""
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: not self._writer and not self._waiting_writers)
+            self._readers += 1
+
+    async def release_read(self):
+        """Releases a read."""
+        async with self._condition:
+            self._readers -= 1
+            self._condition.notify_all()
+
+    async def acquire_write(self):
+        """Waits until nobody holds the lock."""
+        async with self._condition:
+            self._waiting_writers += 1
+            try:
+                await self._condition.wait_for(
+                    lambda: not self._writer and not self._readers)
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+
+    async def release_write(self):
+        """Releases a write."""
+        async with self._condition:
+            self._writer = False
+            self._condition.notify_all()
+
+
+class UserSession:
+    """Open storage and MovieApp of one user and backend. users counts the
+    requests running on it, an evicted session is closed by the last one."""
+
+    def __init__(self, key, user, storage, lock):
+        self.key = key
+        self.user = user
+        self.storage = storage
+        self.app = MovieApp(storage)
+        self.lock = lock
+        self.users = 0
+        self.evicted = False
+
+
+class MovieApiServer:
+    """Routes requests to the sessions of the authenticated users."""
+
+    def __init__(self, max_sessions=256, file_workers=8, network_workers=32):
+        self._sessions = OrderedDict()
+        self._max_sessions = max_sessions
+        # lock of every cached or still used session, a session opened while
+        # an evicted one of the same key finishes shares its lock
+        self._locks = {}
+        self._file_pool = ThreadPoolExecutor(file_workers, thread_name_prefix="movie-file")
+        self._network_pool = ThreadPoolExecutor(network_workers, thread_name_prefix="movie-omdb")
+
+    async def _in_files(self, function, *args):
+        """Runs blocking file work in the file pool."""
+        return await asyncio.get_running_loop().run_in_executor(self._file_pool, function, *args)
+
+    async def _in_network(self, function, *args):
+        """Runs blocking network work in the network pool."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._network_pool, function, *args)
+
+    @staticmethod
+    def _credentials(headers):
+        """Returns (username, password) of the basic auth header."""
+        kind, _, encoded = headers.get("authorization", "").partition(" ")
+        if kind.lower() != "basic":
+            raise ApiError(401, "Basic authentication required")
+        try:
+            username, _, password = base64.b64decode(encoded).decode("utf-8").partition(":")
+        except (binascii.Error, UnicodeDecodeError) as error:
+            raise ApiError(401, "Invalid authorization header") from error
+        return username, password
+
+    async def _session(self, headers, query):
+        """Authenticates the request and returns its (cached) session,
+        counted as used until _release()."""
+        username, password = self._credentials(headers)
+        user = UserShell({"username": username, "password": password})
+        try:
+            valid = await self._in_files(user.is_password_correct)
+        except UserShellError as error:
+            raise ApiError(401, str(error)) from error
+        if not valid:
+            raise ApiError(401, "Password is not correct")
+        backend = query.get("backend", ["json"])[0].strip().lower()
+        key = (user.user_name, backend)
+        session = self._sessions.get(key)
+        if session is None:
+            try:
+                storage = await self._in_files(
+                    get_user_storage, backend, user.get_user_movie_path())
+            except UserShellError as error:
+                raise ApiError(400, str(error)) from error
+            session = self._sessions.get(key)
+            if session is None:
+                session = UserSession(key, user, storage,
+                                      self._locks.setdefault(key, ReadWriteLock()))
+                self._sessions[key] = session
+            else:  # opened by a concurrent request meanwhile
+                self._file_pool.submit(storage.close)
+        self._sessions.move_to_end(key)
+        session.users += 1
+        while len(self._sessions) > self._max_sessions:
+            _, evicted = self._sessions.popitem(last=False)
+            evicted.evicted = True
+            if not evicted.users:
+                await self._close(evicted)
+        return session
+
+    async def _release(self, session):
+        """Ends a request on session, closes it when it was evicted meanwhile."""
+        session.users -= 1
+        if session.evicted and not session.users:
+            await self._close(session)
+
+    async def _close(self, session):
+        """Closes the storage of an evicted session and forgets its lock
+        unless a newer session of the same key uses it."""
+        if session.key not in self._sessions and self._locks.get(session.key) is session.lock:
+            del self._locks[session.key]
+        await self._in_files(session.storage.close)
+
+    async def _read(self, lock, function, *args):
+        """Runs a read under the shared lock."""
+        await lock.acquire_read()
+        try:
+            return await self._in_files(function, *args)
+        finally:
+            await lock.release_read()
+
+    async def _write(self, lock, function, *args):
+        """Runs a write under the exclusive lock."""
+        await lock.acquire_write()
+        try:
+            return await self._in_files(function, *args)
+        finally:
+            await lock.release_write()
+
+    async def _register(self, body):
+        """Creates a user."""
+        if not body.get("username") or not body.get("password"):
+            raise ApiError(400, "username and password are required")
+        user = UserShell({"username": body["username"], "password": body["password"]})
+
+        def register():
+            try:
+                user.registry()
+            except UserShellError:
+                return False
+            return True
+        if not await self._in_files(register):
+            raise ApiError(409, "User is already registered")
+        return 201, {"username": user.user_name}
+
+    @staticmethod
+    def _store_movie(session, movie_data):
+        """Adds a looked up movie unless it (or a title differing only in
+        case, accents, punctuation or article) is already stored."""
+        session.app.check_new(movie_data["Title"])
+        session.storage.add_movie(movie_data["Title"], movie_data["Year"],
+                                  movie_data["imdbRating"], movie_data.get("Poster"))
+
+    async def _add_movie(self, session, body):
+        """Looks the title up in the network pool, then stores it."""
+        title = str(body.get("title", "")).strip()
+        if not title:
+            raise ApiError(400, "title is required")
+        await self._read(session.lock, session.app.check_new, MovieApp.read_movie_name(title))
+        movie_data, reason = await self._in_network(MovieApp._fetch_movie, title)
+        if movie_data is None:
+            raise ApiError(404, reason)
+        await self._write(session.lock, self._store_movie, session, movie_data)
+        return 201, {"title": movie_data["Title"], "Year": movie_data["Year"],
+                     "imdbRating": movie_data["imdbRating"], "Poster": movie_data.get("Poster")}
+
+    @staticmethod
+    def _number(query, name, default, function=int):
+        """Reads a numeric query parameter."""
+        value = query.get(name, [None])[0]
+        if value is None:
+            return default
+        try:
+            return function(value)
+        except ValueError as error:
+            raise ApiError(400, f"Invalid {name}") from error
+
+    @staticmethod
+    def _page(storage, offset, limit):
+        """Returns a page of the library as a list of movies."""
+        movies = islice(storage.iter_movies(), offset, offset + limit)
+        return [dict(info, title=title) for title, info in movies]
+
+    async def _webpage(self, session):
+        """Downloads the missing posters in the network pool, then writes
+        the paged site (which finds every poster cached) in the file pool."""
+        records = await self._read(session.lock, session.storage.list_records)
+        await self._in_network(get_poster_cache().prefetch,
+                               [record.poster for record in records])
+        return await self._read(session.lock, webCalls.create_paged_site,
+                                session.user, session.storage)
+
+    async def dispatch(self, method, path, query, headers, body):
+        """Returns (status, payload) for one request."""
+        parts = [unquote(part) for part in path.strip("/").split("/") if part]
+        if parts == ["users"] and method == "POST":
+            return await self._register(body)
+        if not parts or parts[0] not in ("movies", "stats", "webpage"):
+            raise ApiError(404, "Not found")
+        session = await self._session(headers, query)
+        try:
+            return await self._route(method, parts, query, body, session)
+        finally:
+            await self._release(session)
+
+    async def _route(self, method, parts, query, body, session):
+        """Runs an authenticated request on session."""
+        storage, app, lock = session.storage, session.app, session.lock
+        if parts == ["movies"] and method == "GET":
+            offset = self._number(query, "offset", 0)
+            limit = self._number(query, "limit", 50)
+            return 200, {"movies": await self._read(lock, self._page, storage, offset, limit)}
+        if parts == ["movies"] and method == "POST":
+            return await self._add_movie(session, body)
+        if parts == ["movies", "sorted"]:
+            if method != "GET":
+                raise ApiError(405, "Method not allowed")
+            descending = query.get("order", ["asc"])[0].lower() == "desc"
+            limit = self._number(query, "limit", None)
+            movies = await self._read(lock, storage.sort_movies, descending, limit)
+            return 200, {"movies": [dict(info, title=title) for title, info in movies]}
+        if len(parts) == 2 and parts[0] == "movies" and method == "DELETE":
+            return 200, {"message": await self._write(lock, app.delete_movie, parts[1])}
+        if len(parts) == 2 and parts[0] == "movies" and method == "PATCH":
+            if "rating" not in body:
+                raise ApiError(400, "rating is required")
+            try:
+                rating = float(body["rating"])
+            except (TypeError, ValueError) as error:
+                raise ApiError(400, "Invalid rating") from error
+            return 200, {"message": await self._write(lock, app.update_movie, parts[1], rating)}
+        if parts == ["stats"] and method == "GET":
+            return 200, await self._read(lock, storage.rating_stats)
+        if parts == ["webpage"] and method == "POST":
+            return 200, {"message": await self._webpage(session)}
+        raise ApiError(405, "Method not allowed")
+
+    async def handle_connection(self, reader, writer):
+        """Serves the requests of one keep-alive connection."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                status, payload = await self._respond(method.upper(), target, headers, reader)
+                keep_alive = (version == "HTTP/1.1"
+                              and headers.get("connection", "").lower() != "close")
+                data = json.dumps(payload).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\n"
+                    "Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                    .encode("latin-1") + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, method, target, headers, reader):
+        """Reads the body and turns errors into status codes."""
+        try:
+            length = int(headers.get("content-length", 0) or 0)
+            if length > MAX_BODY:
+                raise ApiError(413, "Request body too large")
+            body = {}
+            if length:
+                try:
+                    body = json.loads(await reader.readexactly(length))
+                except ValueError as error:
+                    raise ApiError(400, "Body is not valid json") from error
+                if not isinstance(body, dict):
+                    raise ApiError(400, "Body must be a json object")
+            url = urlsplit(target)
+            return await self.dispatch(method, url.path, parse_qs(url.query), headers, body)
+        except ApiError as error:
+            return error.status, {"error": str(error)}
+        except MovieNotFoundError as error:
+            return 404, {"error": str(error)}
+        except MovieExistsError as error:
+            return 409, {"error": str(error)}
+        except (AppError, StorageError, FunctionErrors) as error:
+            return 400, {"error": str(error)}
+        except ValueError:
+            return 400, {"error": "Invalid request"}
+        except Exception as error:  # keep serving other requests
+            return 500, {"error": repr(error)}
+
+    async def serve(self, host, port):
+        """Runs the server until cancelled."""
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-sessions", type=int, default=256)
+    parser.add_argument("--file-workers", type=int, default=8)
+    parser.add_argument("--network-workers", type=int, default=32)
+    args = parser.parse_args()
+    api = MovieApiServer(args.max_sessions, args.file_workers, args.network_workers)
+    try:
+        asyncio.run(api.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
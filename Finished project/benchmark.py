@@ -0,0 +1,245 @@
+"""Benchmarks storage backends and MovieApp operations on synthetic libraries.
+
+    python benchmark.py --sizes 1000,10000 --save-baseline bench_baseline.json
+    python benchmark.py --sizes 1000,10000 --baseline bench_baseline.json
+
+Every (backend, size) case runs in its own process so peak RSS belongs to
+that case. OMDb is replaced by a local stub server. Every operation is
+timed --repeats times, each time on a freshly opened storage, and the
+median is reported. With --baseline the run exits with status 1 when an
+operation got slower than the tolerance."""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+BACKENDS = ["json", "journal", "csv", "sqlite", "mmap"]
+OPERATIONS = ["list_movies", "add_movie", "delete_movie", "update_movie",
+              "get_sort_movies", "get_stat_movies", "create_webpage"]
+# differences below this many seconds are never reported as regressions
+NOISE_FLOOR = 0.002
+REPEATS = 5
+
+
+class StubOmdbHandler(BaseHTTPRequestHandler):
+    """Answers every ?t=<title> like OMDb would for an existing movie."""
+
+    def do_GET(self):
+        """Builds a deterministic movie from the requested title."""
+        title = parse_qs(urlparse(self.path).query).get("t", [""])[0]
+        body = json.dumps({
+            "Response": "True", "Title": title, "Year": "2001",
+            "imdbRating": f"{len(title) % 10}.{len(title) % 7}",
+            "Poster": f"https://m.media-amazon.com/images/M/{abs(hash(title))}.jpg"
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Keeps the benchmark output clean."""
+
+
+def start_stub_server():
+    """Starts the OMDb stub on a free local port and returns its url."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubOmdbHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+class BenchUser:
+    """Minimal stand in for UserShell used by create_webpage."""
+
+    def __init__(self, folder):
+        self._folder = folder
+
+    def get_html_index(self):
+        """get html index"""
+        return os.path.join(SCRIPT_DIR, "_static", "index_template.html")
+
+    def get_updated_path(self):
+        """get updated html path"""
+        return os.path.join(self._folder, "bench.html")
+
+
+def synthetic_movies(size, seed=1):
+    """Yields size (title, year, rating, poster) tuples."""
+    generator = random.Random(seed)
+    for number in range(size):
+        yield (f"Synthetic Movie {number:07d}", str(generator.randint(1920, 2024)),
+               round(generator.uniform(1, 10), 1),
+               f"https://m.media-amazon.com/images/M/{number:07d}.jpg")
+
+
+def written_bytes():
+    """Bytes written by this process so far (Linux only, else 0)."""
+    try:
+        with open("/proc/self/io", "r", encoding="utf-8") as io_file:
+            for line in io_file:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def open_storage(backend, path):
+    """Opens backend the way the application does."""
+    from movie_user_app import get_user_storage
+    return get_user_storage(backend, path)
+
+
+def run_case(backend, size, stub_url, queue, repeats=REPEATS):
+    """Builds a library of size movies and times every operation repeats
+    times, each round on a freshly opened storage and with its own titles.
+    Puts the result dictionary with the median timings on queue."""
+    sys.path.insert(0, SCRIPT_DIR)
+    folder = tempfile.mkdtemp(prefix="movie-bench-")
+    try:
+        os.environ["OMDB_BASE_URL"] = stub_url
+        os.environ["OMDB_CACHE_PATH"] = os.path.join(folder, "omdb.sqlite3")
+        import movies_storage
+        from movie_user_app import MovieApp
+        path = os.path.join(folder, "library")
+        open_storage(backend, path).add_movies(synthetic_movies(size))
+        user = BenchUser(folder)
+        samples = {operation: [] for operation in OPERATIONS}
+        for repeat in range(repeats):
+            storage = open_storage(backend, path)
+            app = MovieApp(storage)
+            calls = {
+                "list_movies": storage.list_movies,
+                "add_movie": lambda: app.add_movie(f"Benchmark Extra Title {repeat}"),
+                "delete_movie": lambda: app.delete_movie(
+                    f"Synthetic Movie {size - 1 - repeat:07d}"),
+                "update_movie": lambda: app.update_movie(
+                    "Synthetic Movie 0000000", 7.7 if repeat % 2 else 6.6),
+                "get_sort_movies": lambda: movies_storage.get_sort_movies(storage, "desc", 20),
+                "get_stat_movies": lambda: movies_storage.get_stat_movies(storage),
+                "create_webpage": lambda: movies_storage.create_webpage(
+                    user, storage, local_posters=False),
+            }
+            for operation in OPERATIONS:
+                before = written_bytes()
+                start = time.perf_counter()
+                calls[operation]()
+                samples[operation].append((time.perf_counter() - start,
+                                           written_bytes() - before))
+            storage.close()
+        timings = {operation: {"seconds": statistics.median(run[0] for run in runs),
+                               "best": min(run[0] for run in runs),
+                               "bytes_written": int(statistics.median(run[1] for run in runs))}
+                   for operation, runs in samples.items()}
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        queue.put({"backend": backend, "size": size, "repeats": repeats,
+                   "peak_rss": peak_rss, "operations": timings})
+    except Exception as error:  # reported by the parent
+        queue.put({"backend": backend, "size": size, "error": repr(error)})
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def run_benchmarks(backends, sizes, repeats=REPEATS):
+    """Runs every case in a spawned process, returns the results."""
+    server, stub_url = start_stub_server()
+    context = multiprocessing.get_context("spawn")
+    results = []
+    try:
+        for size in sizes:
+            for backend in backends:
+                queue = context.Queue()
+                process = context.Process(
+                    target=run_case, args=(backend, size, stub_url, queue, repeats))
+                process.start()
+                result = queue.get()
+                process.join()
+                results.append(result)
+                print_result(result)
+    finally:
+        server.shutdown()
+    return results
+
+
+def print_result(result):
+    """Prints one case."""
+    title = f"{result['backend']:>8} {result['size']:>8}"
+    if "error" in result:
+        print(f"{title}  FAILED {result['error']}")
+        return
+    timings = "  ".join(f"{name}={values['seconds'] * 1000:.1f}ms"
+                        for name, values in result["operations"].items())
+    print(f"{title}  rss={result['peak_rss'] / 2 ** 20:.0f}MiB  {timings}")
+
+
+def compare(results, baseline, tolerance):
+    """Returns the regressions of results against baseline."""
+    saved = {(item["backend"], item["size"]): item for item in baseline}
+    regressions = []
+    for result in results:
+        previous = saved.get((result["backend"], result["size"]))
+        if previous is None or "error" in previous:
+            continue
+        if "error" in result:
+            regressions.append(f"{result['backend']}/{result['size']}: {result['error']}")
+            continue
+        for name, values in result["operations"].items():
+            old = previous["operations"].get(name)
+            if old is None:
+                continue
+            limit = old["seconds"] * (1 + tolerance)
+            if values["seconds"] > limit and values["seconds"] - old["seconds"] > NOISE_FLOOR:
+                regressions.append(
+                    f"{result['backend']}/{result['size']} {name}: "
+                    f"{old['seconds'] * 1000:.1f}ms -> {values['seconds'] * 1000:.1f}ms")
+        if result["peak_rss"] > previous["peak_rss"] * (1 + tolerance):
+            regressions.append(
+                f"{result['backend']}/{result['size']} peak_rss: "
+                f"{previous['peak_rss']} -> {result['peak_rss']}")
+    return regressions
+
+
+def main():
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000",
+                        help="comma separated library sizes, e.g. 1000,100000,1000000")
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--repeats", type=int, default=REPEATS,
+                        help=f"timed rounds per operation, the median is kept (default {REPEATS})")
+    parser.add_argument("--output", help="write the results as json")
+    parser.add_argument("--save-baseline", help="write the results as the new baseline")
+    parser.add_argument("--baseline", help="compare against a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown as a fraction (default 0.25)")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    results = run_benchmarks(args.backends.split(","), sizes, max(1, args.repeats))
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as result_file:
+                json.dump(results, result_file, indent=4)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print("REGRESSIONS:\n" + "\n".join(regressions))
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
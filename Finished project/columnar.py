@@ -0,0 +1,226 @@
+"""Column arrays of a loaded library for sorting, statistics and filters.
+
+With NumPy installed the year and rating columns are arrays and every
+query is vectorized; without it the same queries run over plain lists.
+Columns of several storages can be combined for cross user analytics.
+ColumnsView keeps the columns of one storage current on every write."""
+from math import ceil, isnan
+from movie_record import Movie
+from movie_views import MovieView
+
+try:
+    import numpy
+except ImportError:  # optional, the list fallback is used
+    numpy = None
+
+UNRATED = float("nan")
+NO_YEAR = 0
+
+
+class MovieColumns:
+    """Titles, years and ratings of many movies in parallel columns.
+    Unrated movies have a NaN rating and years that aren't a plain number
+    (series like "2010–2013") are NO_YEAR, their text is kept in
+    year_texts by title. Titles stay a python list, the other columns are
+    parallel to it."""
+
+    def __init__(self, titles, years, ratings, year_texts=None):
+        self.titles = titles
+        self.year_texts = year_texts if year_texts is not None else {}
+        if numpy is not None:
+            years = numpy.asarray(years, dtype=numpy.int32)
+            ratings = numpy.asarray(ratings, dtype=numpy.float64)
+        self.years = years
+        self.ratings = ratings
+        self._ranks = None
+        self._order = None
+
+    @classmethod
+    def from_records(cls, records):
+        """Builds the columns from movie_record.Movie records."""
+        titles, years, ratings, year_texts = [], [], [], {}
+        for record in records:
+            titles.append(record.title)
+            if isinstance(record.year, int):
+                years.append(record.year)
+            else:
+                years.append(NO_YEAR)
+                if record.year is not None:
+                    year_texts[record.title] = record.year
+            ratings.append(UNRATED if record.rating is None else record.rating)
+        return cls(titles, years, ratings, year_texts)
+
+    @classmethod
+    def from_storage(cls, storage):
+        """Builds the columns of every movie of an IStorage."""
+        return cls.from_records(storage.list_records())
+
+    @classmethod
+    def combine(cls, columns):
+        """Concatenates the columns of several libraries."""
+        columns = list(columns)
+        titles = [title for part in columns for title in part.titles]
+        year_texts = {title: text for part in columns for title, text in part.year_texts.items()}
+        if numpy is not None and columns:
+            return cls(titles, numpy.concatenate([part.years for part in columns]),
+                       numpy.concatenate([part.ratings for part in columns]), year_texts)
+        return cls(titles, [year for part in columns for year in part.years],
+                   [rating for part in columns for rating in part.ratings], year_texts)
+
+    def __len__(self):
+        return len(self.titles)
+
+    def _rating_order(self):
+        """Positions ordered by rating then title, unrated first. Built
+        once: a stable sort by rating of the positions in title order."""
+        if self._order is None:
+            if numpy is not None:
+                by_title = numpy.argsort(numpy.array(self.titles, dtype=object), kind="stable")
+                keys = numpy.where(numpy.isnan(self.ratings), -numpy.inf, self.ratings)
+                self._order = by_title[numpy.argsort(keys[by_title], kind="stable")]
+            else:
+                by_title = sorted(range(len(self.titles)), key=self.titles.__getitem__)
+                self._order = sorted(by_title, key=lambda position: (
+                    float("-inf") if isnan(self.ratings[position]) else self.ratings[position]))
+        return self._order
+
+    def _entry(self, position):
+        """Converts a position to a (title, info) pair like sort_movies."""
+        title = self.titles[position]
+        rating = float(self.ratings[position])
+        year = int(self.years[position])
+        return title, {"Year": str(year) if year != NO_YEAR else self.year_texts.get(title),
+                       "imdbRating": "N/A" if isnan(rating) else rating}
+
+    def sort(self, descending=False, limit=None, offset=0):
+        """Returns (title, info) pairs ordered by rating then title, unrated
+        movies first, limit pairs from offset like IStorage.sort_movies."""
+        order = self._rating_order()
+        if descending:
+            order = order[::-1]
+        stop = None if limit is None else offset + limit
+        order = order[offset:stop]
+        if numpy is not None:
+            order = order.tolist()
+        return [self._entry(position) for position in order]
+
+    def _rated(self):
+        """Ratings of the rated movies, unordered."""
+        if numpy is not None:
+            return self.ratings[~numpy.isnan(self.ratings)]
+        return [rating for rating in self.ratings if not isnan(rating)]
+
+    def percentiles(self, percents):
+        """Returns {percent: rating} of the rated movies (nearest rank),
+        an empty dictionary when nothing is rated. NumPy selects the ranks
+        with a partition instead of a full sort."""
+        rated = self._rated()
+        if not len(rated):
+            return {}
+        ranks = {percent: max(1, ceil(percent / 100 * len(rated))) - 1 for percent in percents}
+        if numpy is not None:
+            rated = numpy.partition(rated, sorted(set(ranks.values())))
+        else:
+            rated.sort()
+        return {percent: float(rated[rank]) for percent, rank in ranks.items()}
+
+    def stats(self):
+        """Returns count, max, min, average and median of the ratings like
+        IStorage.rating_stats."""
+        rated = self._rated()
+        if not len(rated):
+            return {"count": 0, "max": None, "min": None, "average": None, "median": None}
+        if numpy is not None:
+            total, highest, lowest = float(rated.sum()), float(rated.max()), float(rated.min())
+        else:
+            total, highest, lowest = sum(rated), max(rated), min(rated)
+        return {"count": len(rated), "max": highest, "min": lowest,
+                "average": total / len(rated), "median": self.percentiles([50])[50]}
+
+    def by_year(self):
+        """Returns {year: (count, average rating)} of the rated movies."""
+        if numpy is not None:
+            rated = ~numpy.isnan(self.ratings)
+            years = self.years[rated]
+            if not len(years):
+                return {}
+            first = int(years.min())
+            counts = numpy.bincount(years - first)
+            sums = numpy.bincount(years - first, weights=self.ratings[rated])
+            return {first + offset: (int(counts[offset]), float(sums[offset] / counts[offset]))
+                    for offset in numpy.flatnonzero(counts).tolist()}
+        totals = {}
+        for year, rating in zip(self.years, self.ratings):
+            if not isnan(rating):
+                total = totals.setdefault(year, [0, 0.0])
+                total[0] += 1
+                total[1] += rating
+        return {year: (count, total / count) for year, (count, total) in sorted(totals.items())}
+
+    def filter(self, year_from=None, year_to=None, rating_from=None, rating_to=None):
+        """Returns the columns of the movies inside the given inclusive
+        ranges, None leaves a side open. Unrated movies only pass when no
+        rating bound is given, movies without a year when no year bound is."""
+        if numpy is not None:
+            mask = numpy.ones(len(self.titles), dtype=bool)
+            if year_from is not None:
+                mask &= self.years >= year_from
+            if year_to is not None:
+                mask &= (self.years <= year_to) & (self.years != NO_YEAR)
+            if rating_from is not None:
+                mask &= self.ratings >= rating_from
+            if rating_to is not None:
+                mask &= self.ratings <= rating_to
+            positions = numpy.flatnonzero(mask)
+            return MovieColumns([self.titles[position] for position in positions.tolist()],
+                                self.years[positions], self.ratings[positions], self.year_texts)
+
+        def keep(year, rating):
+            if year_from is not None and year < year_from:
+                return False
+            if year_to is not None and (year > year_to or year == NO_YEAR):
+                return False
+            if rating_from is not None and not rating >= rating_from:
+                return False
+            return rating_to is None or rating <= rating_to
+        positions = [position for position, (year, rating)
+                     in enumerate(zip(self.years, self.ratings)) if keep(year, rating)]
+        return MovieColumns([self.titles[position] for position in positions],
+                            [self.years[position] for position in positions],
+                            [self.ratings[position] for position in positions],
+                            self.year_texts)
+
+
+class ColumnsView(MovieView):
+    """MovieColumns of one storage. The records are fed every mutation
+    like the other views and the columns are rebuilt from them on the
+    next query after a change, the storage signature alone doesn't show
+    every write (sqlite's data_version ignores the connection's own
+    commits, file signatures stand still inside deferred_writes)."""
+
+    def reset(self):
+        self._records = {}
+        self._columns = None
+
+    def add(self, title, info):
+        self._records[title] = Movie.from_info(title, info)
+        self._columns = None
+
+    def remove(self, title):
+        if self._records.pop(title, None) is not None:
+            self._columns = None
+
+    def update(self, title, changes):
+        record = self._records.get(title)
+        if record is not None and "imdbRating" in changes:
+            self._records[title] = Movie(title, record.year, changes["imdbRating"],
+                                         record.poster)
+            self._columns = None
+
+    def columns(self):
+        """Returns the current MovieColumns."""
+        with self._reading():
+            self.refresh()
+            if self._columns is None:
+                self._columns = MovieColumns.from_records(self._records.values())
+            return self._columns
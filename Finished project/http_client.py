@@ -0,0 +1,99 @@
+"""Shared HTTP client: pooled keep-alive connections, retries with
+exponential backoff and jitter, and a concurrency limit per host."""
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class HttpClient:
+    """Wraps a requests.Session. Connection errors, timeouts and
+    RETRY_STATUS answers are retried up to retries times, sleeping a
+    random time up to backoff * 2 ** attempt (capped by max_backoff)."""
+
+    def __init__(self, pool_size=16, retries=3, backoff=0.5, max_backoff=8.0,
+                 connect_timeout=3.05, read_timeout=10, per_host_limit=8):
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._retries = retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._per_host_limit = per_host_limit
+        self._host_slots = {}
+        self._lock = threading.Lock()
+
+    def _host_slot(self, url):
+        """Returns the semaphore limiting requests in flight to url's host."""
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self._per_host_limit)
+            return self._host_slots[host]
+
+    def _wait(self, attempt, response=None):
+        """Sleeps before the next attempt, honouring a numeric Retry-After."""
+        delay = min(self._max_backoff, self._backoff * 2 ** attempt)
+        if response is not None:
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = min(self._max_backoff, float(retry_after))
+                time.sleep(delay)
+                return
+        time.sleep(random.uniform(0, delay))
+
+    def get(self, url, connect_timeout=None, read_timeout=None, **kwargs):
+        """GET url with retries. Returns the last response, raises the
+        requests exception of the last attempt when every attempt failed."""
+        timeout = (connect_timeout or self._connect_timeout,
+                   read_timeout or self._read_timeout)
+        slot = self._host_slot(url)
+        for attempt in range(self._retries + 1):
+            try:
+                with slot:
+                    response = self._session.get(url, timeout=timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == self._retries:
+                    raise
+                self._wait(attempt)
+                continue
+            if response.status_code in RETRY_STATUS and attempt < self._retries:
+                response.close()
+                self._wait(attempt, response)
+                continue
+            return response
+        return None
+
+    def close(self):
+        """Closes the pooled connections."""
+        self._session.close()
+
+
+def get_client():
+    """Returns the shared client, created on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient()
+        return _client
+
+
+def configure(**settings):
+    """Replaces the shared client with one built from settings
+    (see HttpClient for the accepted keywords)."""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = HttpClient(**settings)
+        return _client
@@ -1,6 +1,6 @@
 '''Ignore user Invalid ENTRy'''
 
-import requests
+import metrics
 
 
 class MinMaxRange(Exception):
@@ -93,6 +93,25 @@ def read_int(prompt):
     return read_number(prompt, int)
 
 
+def read_optional_number(prompt, function):
+    '''
+    Displays a prompt and reads in a number converted by function.
+    Keyboard interrupts (CTRL+C) are ignored
+    Invalid numbers are rejected
+    returns the number, None when the entry is left empty
+    '''
+    while True:
+        try:
+            number_text = input(prompt).strip()
+            if number_text == '':
+                return None
+            return function(number_text)
+        except ValueError:
+            print("!!!!INVALID ENTRY!!!!")
+        except KeyboardInterrupt:
+            print('Do interrupt the process')
+
+
 def read_float_ranged(prompt, min_value, max_value):
     '''
     Displays a prompt and reads in a floating point number.
@@ -125,10 +144,13 @@ def ask_to_continue(prompt):
     return 'y' in ask.lower()
 
 
+@metrics.timed("movie_page_request")
 def page_request(url):
-    """Error Handled Requests"""
+    """Error Handled Requests, the network stack is imported on first use"""
+    import requests
+    import http_client
     try:
-        result = requests.get(url, timeout=10)
+        result = http_client.get_client().get(url, read_timeout=10)
         result.raise_for_status()
         return result
     except requests.exceptions.RequestException as exc:
@@ -1,9 +1,48 @@
 """Interface for storage classes"""
+import functools
+from contextlib import contextmanager, nullcontext
 from abc import ABC, abstractmethod
+from movie_views import RatingIndex, RatingStats
+from movie_record import Movie
+
+
+def _mutation(method):
+    """Wraps a storage mutator so it runs under the backend's write lock
+    and the attached views are told about the change once the outermost
+    mutator returned (backends may call other mutators internally, e.g.
+    add_movies calling add_movie)."""
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        with self._write_lock():
+            views = self.__dict__.get("_views")
+            if not views or self.__dict__.get("_mutating"):
+                return method(self, *args)
+            if method.__name__ == "add_movies":
+                args = (list(args[0]),)
+            before = self.signature()
+            self._mutating = True
+            try:
+                result = method(self, *args)
+            finally:
+                self._mutating = False
+            for view in views.values():
+                view.movie_changed(method.__name__, args, result, before)
+            return result
+    return wrapper
 
 
 class IStorage(ABC):
     """METHODS for storage classes"""
+    MUTATORS = ("add_movie", "add_movies", "delete_movie", "update_movie")
+
+    def __init_subclass__(cls, **kwargs):
+        """Wraps the mutators a backend defines, see _mutation."""
+        super().__init_subclass__(**kwargs)
+        for name in IStorage.MUTATORS:
+            method = cls.__dict__.get(name)
+            if method is not None and not getattr(method, "__isabstractmethod__", False):
+                setattr(cls, name, _mutation(method))
+
     @abstractmethod
     def list_movies(self):
         """list_movies is a method that returns a dictionary."""
@@ -24,6 +63,100 @@ class IStorage(ABC):
         """update_movie is a method that returns a dictionary."""
         pass
 
+    def iter_movies(self):
+        """Yields (title, info) pairs of every movie. Backends that can read
+        their file piece by piece override this so memory stays flat."""
+        yield from list(self.list_movies().items())
+
+    def get_movie(self, title):
+        """Returns the movie info of title or None. Backends with an index
+        override this to skip loading the library."""
+        return self.list_movies().get(title)
+
+    def list_records(self):
+        """Returns every movie as a movie_record.Movie. Backends reading
+        rows one by one override this so no dictionaries are built."""
+        return [Movie.from_info(title, info) for title, info in self.list_movies().items()]
+
+    def add_movies(self, movies):
+        """Adds (title, year, rating, poster) tuples and returns the titles
+        that were skipped because they already exist.
+        Backends override this to store the whole batch in a single write."""
+        skipped = []
+        existing = set(self.list_movies())
+        for title, year, rating, poster in movies:
+            if title in existing:
+                skipped.append(title)
+                continue
+            self.add_movie(title, year, rating, poster)
+            existing.add(title)
+        return skipped
+
+    def _write_lock(self):
+        """Context manager held around every mutator (read-modify-write).
+        File backends return an exclusive cross process lock."""
+        return nullcontext()
+
+    def _read_lock(self):
+        """Context manager held around reads that must see one state of
+        the data (view rebuilds). File backends return a shared lock."""
+        return nullcontext()
+
+    def signature(self):
+        """Value that changes whenever the stored data changes,
+        None when the backend can't tell."""
+        return None
+
+    def sidecar_path(self, suffix):
+        """Path of a file derived from the stored data (e.g. a saved index)
+        kept next to it, None when the backend has no file signature that
+        could tell whether the derived file is still current."""
+        return None
+
+    def close(self):
+        """Releases the files or connections the storage keeps open, the
+        default keeps none."""
+
+    @contextmanager
+    def deferred_writes(self):
+        """Changes made inside the block may be written once at its end.
+        Backends whose writes are already cheap keep the default, which
+        writes every change right away."""
+        yield self
+
+    def _signature_moved(self, before):
+        """Tells the attached views that a write of changes they already
+        know (e.g. a deferred flush) moved the signature from before."""
+        after = self.signature()
+        for view in self.__dict__.get("_views", {}).values():
+            view.signature_moved(before, after)
+
+    def _invalidate_views(self):
+        """Makes the attached views rebuild, e.g. after dropped changes."""
+        for view in self.__dict__.get("_views", {}).values():
+            view.invalidate()
+
+    def view(self, view_class):
+        """Returns the view_class (see movie_views) attached to this
+        storage, created on first use and kept up to date on mutations."""
+        views = self.__dict__.setdefault("_views", {})
+        view = views.get(view_class)
+        if view is None:
+            view = views.setdefault(view_class, view_class(self))
+        return view
+
+    def sort_movies(self, descending=False, limit=None, offset=0):
+        """Returns a list of (title, info) pairs ordered by imdbRating,
+        limit pairs starting at offset. Backends that can sort natively
+        override this, the others use the attached RatingIndex."""
+        return self.view(RatingIndex).page(offset, limit, descending)
+
+    def rating_stats(self):
+        """Returns a dictionary with count, max, min, average and median
+        of imdbRating. Backends that can aggregate natively override this,
+        the others read the attached RatingStats."""
+        return self.view(RatingStats).summary()
+
     # create a list of 100 numbers from 0 to 99
 
     # odd_numbers = [x for x in range(100) if x % 2 == 1]
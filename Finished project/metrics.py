@@ -0,0 +1,251 @@
+"""Timing histograms, counters and gauges for storage and OMDb calls.
+
+Metrics are off unless enable() is called or one of the environment
+variables MOVIE_METRICS_PROM (Prometheus text file) or MOVIE_METRICS_JSON
+(json dump) names an output file; both are written on exit. While
+disabled, instrument_storage() returns the storage untouched and the
+other hooks return after a single flag check."""
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STORAGE_METHODS = ("list_movies", "list_records", "iter_movies", "get_movie", "add_movie",
+                   "add_movies", "delete_movie", "update_movie", "sort_movies", "rating_stats")
+# methods returning an iterator, timed over the whole iteration
+ITERATOR_METHODS = ("iter_movies",)
+
+
+class Registry:
+    """Holds every metric, keyed by name and a sorted tuple of labels."""
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._collectors = []
+
+    def inc(self, name, amount=1, **labels):
+        """Adds amount to a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def gauge_add(self, name, amount, **labels):
+        """Adds amount (may be negative) to a gauge."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        """Records a duration in a histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+            for position, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[0][position] += 1
+                    break
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def add_collector(self, collector):
+        """Registers a function returning {name: value} gauges read at export
+        time, used for values other modules already count (cache hits)."""
+        self._collectors.append(collector)
+
+    def snapshot(self):
+        """Returns every metric as plain data."""
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = {key: (list(value[0]), value[1], value[2])
+                          for key, value in self._histograms.items()}
+        for collector in self._collectors:
+            for name, value in collector().items():
+                gauges[(name, ())] = value
+        return counters, gauges, histograms
+
+    def reset(self):
+        """Drops every recorded value."""
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+
+REGISTRY = Registry()
+
+
+def _labels_text(labels, extra=()):
+    """Formats labels for the Prometheus text format."""
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+def prometheus_text(registry=REGISTRY):
+    """Returns the metrics in the Prometheus text exposition format."""
+    counters, gauges, histograms = registry.snapshot()
+    lines = []
+    for kind, values in (("counter", counters), ("gauge", gauges)):
+        for name in sorted({key[0] for key in values}):
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(f"{name}{_labels_text(labels)} {value}"
+                         for (metric, labels), value in values.items() if metric == name)
+    for name in sorted({key[0] for key in histograms}):
+        lines.append(f"# TYPE {name} histogram")
+        for (metric, labels), (counts, total, count) in histograms.items():
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_labels_text(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{_labels_text(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{_labels_text(labels)} {total}")
+            lines.append(f"{name}_count{_labels_text(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def json_dump(registry=REGISTRY):
+    """Returns the metrics as a json serializable dictionary."""
+    counters, gauges, histograms = registry.snapshot()
+
+    def entries(values):
+        return [{"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in values.items()]
+    return {"counters": entries(counters), "gauges": entries(gauges),
+            "histograms": [{"name": name, "labels": dict(labels), "buckets": list(BUCKETS),
+                            "counts": counts, "sum": total, "count": count}
+                           for (name, labels), (counts, total, count) in histograms.items()]}
+
+
+def _write_atomic(path, text):
+    """Writes text to path through a temporary file, so a scraper never
+    reads half a file."""
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as metrics_file:
+        metrics_file.write(text)
+    os.replace(temp_path, path)
+
+
+def write_prometheus(path, registry=REGISTRY):
+    """Writes a Prometheus text file (node exporter textfile collector)."""
+    _write_atomic(path, prometheus_text(registry))
+
+
+def write_json(path, registry=REGISTRY):
+    """Writes the json dump."""
+    _write_atomic(path, json.dumps(json_dump(registry), indent=4))
+
+
+def enable(prometheus_path=None, json_path=None):
+    """Turns metrics on and writes the given outputs on exit."""
+    REGISTRY.enabled = True
+    if prometheus_path:
+        atexit.register(write_prometheus, prometheus_path)
+    if json_path:
+        atexit.register(write_json, json_path)
+
+
+def disable():
+    """Turns metrics off, already instrumented storages stop recording."""
+    REGISTRY.enabled = False
+
+
+def count(name, amount=1, **labels):
+    """Adds to a counter when metrics are on."""
+    if REGISTRY.enabled:
+        REGISTRY.inc(name, amount, **labels)
+
+
+def _record(name, labels, call, *args, **kwargs):
+    """Runs call and records calls, errors, duration and activity."""
+    REGISTRY.inc(f"{name}_calls_total", **labels)
+    REGISTRY.gauge_add(f"{name}_active", 1, **labels)
+    start = time.perf_counter()
+    try:
+        return call(*args, **kwargs)
+    except Exception:
+        REGISTRY.inc(f"{name}_errors_total", **labels)
+        raise
+    finally:
+        REGISTRY.observe(f"{name}_seconds", time.perf_counter() - start, **labels)
+        REGISTRY.gauge_add(f"{name}_active", -1, **labels)
+
+
+def _record_iteration(name, labels, call, *args, **kwargs):
+    """Like _record for a call returning an iterator. The duration is the
+    time spent producing the items, summed over the iteration, recorded
+    when it ends or is abandoned (the iterator is closed then)."""
+    REGISTRY.inc(f"{name}_calls_total", **labels)
+    REGISTRY.gauge_add(f"{name}_active", 1, **labels)
+    iterator = None
+    elapsed = 0.0
+    start = time.perf_counter()
+    try:
+        iterator = iter(call(*args, **kwargs))
+        while True:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - start
+            yield item
+            start = time.perf_counter()
+    except Exception:
+        REGISTRY.inc(f"{name}_errors_total", **labels)
+        raise
+    finally:
+        if iterator is not None and hasattr(iterator, "close"):
+            iterator.close()
+        REGISTRY.observe(f"{name}_seconds", elapsed, **labels)
+        REGISTRY.gauge_add(f"{name}_active", -1, **labels)
+
+
+def timed(name, **labels):
+    """Decorator recording calls, errors and duration of a function."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not REGISTRY.enabled:
+                return function(*args, **kwargs)
+            return _record(name, labels, function, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument_storage(storage):
+    """Wraps the IStorage methods of one storage instance. Returns the
+    storage unchanged while metrics are off."""
+    if not REGISTRY.enabled:
+        return storage
+    backend = type(storage).__name__
+    for method_name in STORAGE_METHODS:
+        method = getattr(storage, method_name, None)
+        if method is None:
+            continue
+        labels = {"backend": backend, "method": method_name}
+        recorder = _record_iteration if method_name in ITERATOR_METHODS else _record
+
+        def wrapper(*args, _method=method, _labels=labels, _recorder=recorder, **kwargs):
+            if not REGISTRY.enabled:
+                return _method(*args, **kwargs)
+            return _recorder("movie_storage", _labels, _method, *args, **kwargs)
+        setattr(storage, method_name, functools.wraps(method)(wrapper))
+    return storage
+
+
+if os.environ.get("MOVIE_METRICS_PROM") or os.environ.get("MOVIE_METRICS_JSON"):
+    enable(os.environ.get("MOVIE_METRICS_PROM"), os.environ.get("MOVIE_METRICS_JSON"))
@@ -0,0 +1,196 @@
+"""Runs movie commands without prompts, from a file or stdin.
+
+    python movie_batch.py --user raven --backend json --commands todo.txt
+    echo "sort desc 20" | python movie_batch.py --user raven --backend csv
+
+One command per line, arguments split like a shell (quote titles with
+spaces), empty lines and lines starting with # are skipped, - leaves a filter
+bound open:
+
+    add "The Matrix"
+    import watchlist.txt
+    delete "The Matrix"
+    update "Alien" 8.6
+    sort desc 20
+    filter 1990 1999 7.5 -
+    search "matrx" 5
+    list
+    stats
+    html
+
+The password comes from --password or MOVIE_APP_PASSWORD. Every command
+runs on the same storage and the writes are made once, after the last
+command (see IStorage.deferred_writes)."""
+import argparse
+import os
+import shlex
+import sys
+import time
+import movies_storage as webCalls
+from movies_storage import FunctionErrors
+from movie_user_app import (MovieApp, UserShell, UserShellError, AppError,
+                            SEARCH_LIMIT, get_user_storage)
+from storage import StorageError
+
+
+class BatchError(Exception):
+    """BatchError is a class for raising errors."""
+
+    def __init__(self, message: str) -> None:
+        super().__init__(message)
+
+
+def _arguments(args, minimum, maximum, usage):
+    """Checks the number of arguments of a command."""
+    if not minimum <= len(args) <= maximum:
+        raise BatchError(f"Usage: {usage}")
+    return args
+
+
+def run_command(user, storage, app, command, args):
+    """Runs one command and returns its output text."""
+    if command == "add":
+        (title,) = _arguments(args, 1, 1, 'add "<title>"')
+        return app.add_movie(title)
+    if command == "import":
+        (file_path,) = _arguments(args, 1, 1, "import <file>")
+        return app.import_movies(file_path)
+    if command == "delete":
+        (title,) = _arguments(args, 1, 1, 'delete "<title>"')
+        return app.delete_movie(title)
+    if command == "update":
+        title, rating = _arguments(args, 2, 2, 'update "<title>" <rating>')
+        try:
+            return app.update_movie(title, float(rating))
+        except ValueError as error:
+            raise BatchError(f"Invalid rating {rating}") from error
+    if command == "sort":
+        _arguments(args, 1, 2, "sort asc|desc [count]")
+        if len(args) == 2 and not args[1].isdigit():
+            raise BatchError(f"Invalid number of movies {args[1]}")
+        return webCalls.get_sort_movies(
+            storage, args[0], int(args[1]) if len(args) == 2 else None)
+    if command == "filter":
+        bounds = _arguments(args, 1, 4, "filter <year from> [year to] [rating from] [rating to]")
+        bounds = bounds + ["-"] * (4 - len(bounds))
+        try:
+            years = [None if bound == "-" else int(bound) for bound in bounds[:2]]
+            ratings = [None if bound == "-" else float(bound) for bound in bounds[2:]]
+        except ValueError as error:
+            raise BatchError(f"Invalid filter bound:\n\t--> {error}") from error
+        return app.filter_movies(*years, *ratings)
+    if command == "search":
+        _arguments(args, 1, 2, 'search "<title>" [count]')
+        if len(args) == 2 and not args[1].isdigit():
+            raise BatchError(f"Invalid number of movies {args[1]}")
+        return app.search_movies(args[0], int(args[1]) if len(args) == 2 else SEARCH_LIMIT)
+    if command == "list":
+        _arguments(args, 0, 0, "list")
+        return app.list_movies()
+    if command == "stats":
+        _arguments(args, 0, 0, "stats")
+        return app.stat_movies()
+    if command == "html":
+        _arguments(args, 0, 0, "html")
+        return user.generate_user_webpage(storage)
+    raise BatchError(f"Unknown command {command}")
+
+
+def _titles_to_add(commands):
+    """Titles the add and import commands of commands will look up."""
+    for words in commands:
+        if not words:
+            continue
+        if words[0].lower() == "add" and len(words) == 2:
+            yield words[1]
+        elif words[0].lower() == "import" and len(words) == 2:
+            try:
+                with open(words[1], "r", encoding="utf-8") as titles_file:
+                    yield from titles_file.read().splitlines()
+            except OSError:  # reported when the command runs
+                pass
+
+
+def run_batch(user, storage, lines, output=sys.stdout):
+    """Runs every command line, reports its output and timing and returns
+    the number of failed commands. The OMDb lookups of the add and import
+    commands, and the poster downloads of an html command, are made first,
+    outside IStorage.deferred_writes, so the storage lock isn't held across
+    network calls."""
+    app = MovieApp(storage)
+    failed = 0
+    total_start = time.perf_counter()
+    commands = []
+    for number, line in enumerate(lines, start=1):
+        try:
+            commands.append((number, line, shlex.split(line, comments=True), None))
+        except ValueError as error:
+            commands.append((number, line, None, error))
+    lookup_start = time.perf_counter()
+    app.prefetch(_titles_to_add(words for _, _, words, _ in commands if words))
+    if any(words and words[0].lower() == "html" for _, _, words, _ in commands):
+        app.prefetch_posters()
+    lookup = (time.perf_counter() - lookup_start) * 1000
+    print(f"[{lookup:9.2f} ms] lookup", file=output)
+    with storage.deferred_writes():
+        for number, line, words, parse_error in commands:
+            if parse_error is not None:
+                print(f"line {number}: {parse_error}", file=output)
+                failed += 1
+                continue
+            if not words:
+                continue
+            start = time.perf_counter()
+            try:
+                result = run_command(user, storage, app, words[0].lower(), words[1:])
+                status = "ok"
+            except (AppError, StorageError, FunctionErrors, BatchError,
+                    KeyError, ValueError) as error:
+                result = str(error)
+                status = "error"
+                failed += 1
+            elapsed = (time.perf_counter() - start) * 1000
+            print(f"[{elapsed:9.2f} ms] {status:5} line {number}: {line.strip()}", file=output)
+            if result:
+                print(result, file=output)
+        flush_start = time.perf_counter()
+    flush = (time.perf_counter() - flush_start) * 1000
+    total = (time.perf_counter() - total_start) * 1000
+    print(f"[{flush:9.2f} ms] write", file=output)
+    print(f"[{total:9.2f} ms] total, {failed} failed", file=output)
+    return failed
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    parser.add_argument("--user", required=True)
+    parser.add_argument("--password", default=os.environ.get("MOVIE_APP_PASSWORD"))
+    parser.add_argument("--backend", default="json",
+                        help="json, journal, csv, sqlite or mmap (default json)")
+    parser.add_argument("--commands", default="-",
+                        help="command file, - reads stdin (default)")
+    args = parser.parse_args(argv)
+
+    if args.password is None:
+        parser.error("--password or MOVIE_APP_PASSWORD is required")
+    try:
+        user = UserShell({"username": args.user, "password": args.password})
+        if not user.is_password_correct():
+            raise UserShellError("Password is not correct!! Aborted")
+        storage = get_user_storage(args.backend, user.get_user_movie_path())
+        if args.commands == "-":
+            failed = run_batch(user, storage, sys.stdin)
+        else:
+            with open(args.commands, "r", encoding="utf-8") as command_file:
+                failed = run_batch(user, storage, command_file)
+    except (UserShellError, OSError) as error:
+        print(f"Application terminated\n\t--> {error}", file=sys.stderr)
+        return 2
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
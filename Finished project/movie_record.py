@@ -0,0 +1,92 @@
+"""Compact record of one stored movie for code that loads many of them."""
+from collections.abc import Mapping
+
+# shared copies of repeated values, one table per kind because equal
+# values of different types (the year 7 and the rating 7.0) share a key
+_years = {}
+_ratings = {}
+_poster_prefixes = {}
+
+
+def _intern(table, value):
+    """Returns the shared copy of value from table."""
+    return table.setdefault(value, value)
+
+
+def _year(year):
+    """Returns year as int, the text itself when it isn't a plain year
+    (series like "2010–2013")."""
+    try:
+        return _intern(_years, int(year))
+    except (TypeError, ValueError):
+        return year
+
+
+def _rating(rating):
+    """Returns rating as float, None when it isn't a number (e.g. "N/A")."""
+    try:
+        return _intern(_ratings, float(rating))
+    except (TypeError, ValueError):
+        return None
+
+
+class Movie(Mapping):
+    """One movie with the year and rating parsed once and the poster url
+    split into an interned prefix and its own file name. Indexing works
+    like the {"Year": ..., "imdbRating": ..., "Poster": ...} dictionaries
+    list_movies() returns, so records can be passed to dict callers."""
+
+    __slots__ = ("title", "year", "rating", "_poster_prefix", "_poster_name")
+    KEYS = ("Year", "imdbRating", "Poster")
+
+    def __init__(self, title, year, rating, poster):
+        self.title = title
+        self.year = _year(year)
+        self.rating = _rating(rating)
+        if poster:
+            prefix, _, name = poster.rpartition("/")
+            self._poster_prefix = _intern(_poster_prefixes, prefix + "/") if prefix else ""
+            self._poster_name = name
+        else:
+            self._poster_prefix = None
+            self._poster_name = poster
+
+    @classmethod
+    def from_info(cls, title, info):
+        """Builds a record from a list_movies() entry."""
+        return cls(title, info.get("Year"), info.get("imdbRating"), info.get("Poster"))
+
+    @property
+    def poster(self):
+        """Poster url."""
+        if self._poster_prefix is None:
+            return self._poster_name
+        return self._poster_prefix + self._poster_name
+
+    def __getitem__(self, key):
+        if key == "Year":
+            return None if self.year is None else str(self.year)
+        if key == "imdbRating":
+            return "N/A" if self.rating is None else self.rating
+        if key == "Poster":
+            return self.poster
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(Movie.KEYS)
+
+    def __len__(self):
+        return len(Movie.KEYS)
+
+    def as_tuple(self):
+        """Returns (title, year, rating, poster) as add_movies() takes it."""
+        return self.title, self["Year"], self["imdbRating"], self.poster
+
+    def __repr__(self):
+        return (f"Movie({self.title!r}, {self.year!r}, {self.rating!r}, "
+                f"{self.poster!r})")
+
+
+def movies_by_title(records):
+    """Returns {title: record}, a drop in for list_movies() results."""
+    return {record.title: record for record in records}
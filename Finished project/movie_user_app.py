@@ -1,13 +1,24 @@
 """MovieApp uses the Storage instance to store and retrieve movie data.
 UserShell interacts with the user and calls the appropriate methods on MovieApp."""
-import shutil
-from storage import StorageJson, StorageCsv, StorageError, os, json
+import sys
+import threading
+from itertools import islice
+from math import isfinite
+from storage import (StorageJson, StorageJsonJournal, StorageCsv, StorageSqlite,
+                     StorageError, MovieExistsError, MovieNotFoundError, os)
+from istorage import IStorage
+from user_registry import UserRegistry, RegistryError
+from title_search import TitleIndex, normalize
 import movies_storage as webCalls
 from movies_storage import FunctionErrors
 import ioput as io
+import metrics
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 FOLDER_DIR = os.path.join(SCRIPT_DIR, "STORAGE")
+IMPORT_WORKERS = 8
+LIST_PAGE_SIZE = 20
+SEARCH_LIMIT = 10
 
 
 class AppError(Exception):
@@ -30,7 +41,7 @@ class MovieApp():
     @staticmethod
     def validate_storage(storage):
         """Validates the storage instance."""
-        if not isinstance(storage, (StorageJson, StorageCsv)):
+        if not isinstance(storage, IStorage):
             raise AppError("Invalid storage instance")
 
     @staticmethod
@@ -63,50 +74,198 @@ class MovieApp():
 
     def __init__(self, storage) -> None:
         self._storage = storage
-
-    def add_movie(self):
-        """Adds a movie to the destinated movies database."""
-        saved_movies = self._storage.list_movies()
-        movie_name = MovieApp.read_movie_name(input("Enter movie name: "))
-        if movie_name in saved_movies:
-            raise AppError("Movie already exists in database")
-        movie_data = webCalls.get_by_name(movie_name)
-        movie_data = MovieApp.format_movie_data(movie_data)
+        self._lookups = {}
+
+    def columns(self):
+        """Returns the columnar.MovieColumns of the library, kept current
+        on every write by the storage's columnar.ColumnsView."""
+        from columnar import ColumnsView
+        return self._storage.view(ColumnsView).columns()
+
+    def add_movie(self, movie_name=None):
+        """Adds a movie to the destinated movies database.
+        Asks the movie name when it is not given."""
+        if movie_name is None:
+            movie_name = input("Enter movie name: ")
+        movie_name = MovieApp.read_movie_name(movie_name)
+        self.check_new(movie_name)
+        fetched = self._lookups.pop(movie_name, None)
+        if fetched is None:
+            movie_data = MovieApp.format_movie_data(webCalls.get_by_name(movie_name))
+        else:
+            movie_data, reason = fetched
+            if movie_data is None:
+                raise AppError(reason)
         name = movie_data.get("Title", None)
+        self.check_new(name)
         year = movie_data.get("Year", None)
         rating = movie_data.get("imdbRating", None)
         poster = movie_data.get("Poster", None)
         self._storage.add_movie(name, year, rating, poster)
         return f"Movie {name} added successfully"
 
-    def list_movies(self):
-        """Returns a list of movies in the database."""
-        movies = self._storage.list_movies()
-        if len(movies) == 0:
-            raise AppError("No movies in database")
-        template = "\n".join(
-            f"{x[0]}. {x[1][0]}, Year: {x[1][1]['Year']}, Rating: {x[1][1]['imdbRating']}"
-            for x in enumerate(movies.items(), start=1))
-        return template
+    def check_new(self, movie_name):
+        """Raises AppError when movie_name or a title differing only in
+        case, accents, punctuation or article is already stored."""
+        if self._storage.get_movie(movie_name) is not None:
+            raise MovieExistsError("Movie already exists in database")
+        stored = self._storage.view(TitleIndex).find(movie_name)
+        if stored is not None:
+            raise MovieExistsError(f"Movie already exists in database as {stored}")
+
+    @staticmethod
+    def _fetch_movie(movie_name):
+        """Looks up one title, returns (movie_data, None) or (None, reason)."""
+        try:
+            movie_data = MovieApp.format_movie_data(webCalls.get_by_name(movie_name))
+        except (AppError, FunctionErrors, KeyError, TypeError, ValueError) as error:
+            return None, str(error)
+        return movie_data, None
+
+    def _lookup(self, movie_name):
+        """Prefetched (movie_data, reason) of movie_name, else looks it up."""
+        fetched = self._lookups.pop(movie_name, None)
+        return MovieApp._fetch_movie(movie_name) if fetched is None else fetched
+
+    def prefetch(self, titles, workers=IMPORT_WORKERS):
+        """Looks up the titles that aren't stored yet concurrently, so a
+        following add_movie or add_movies makes no OMDb request. Lets a
+        caller hold the storage write lock without network calls."""
+        index = self._storage.view(TitleIndex)
+        names = []
+        for title in titles:
+            if title.strip() == "":
+                continue
+            movie_name = MovieApp.read_movie_name(title)
+            if movie_name not in self._lookups and movie_name not in names and \
+                    index.find(movie_name) is None:
+                names.append(movie_name)
+        if not names:
+            return
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            self._lookups.update(zip(names, executor.map(MovieApp._fetch_movie, names)))
+
+    def prefetch_posters(self):
+        """Downloads the posters of the stored movies and of the prefetched
+        titles to the poster cache, so a following webpage build finds them
+        cached and makes no request. Returns the PosterCache.prefetch report."""
+        from poster_cache import get_poster_cache
+        urls = [record.poster for record in self._storage.list_records()]
+        urls.extend(movie_data.get("Poster") for movie_data, _ in self._lookups.values()
+                    if movie_data is not None)
+        return get_poster_cache().prefetch(urls)
+
+    def add_movies(self, titles, workers=IMPORT_WORKERS):
+        """Looks up titles concurrently with at most workers OMDb requests
+        in flight and stores every found movie with a single storage write.
+        Returns a report dictionary with "added" and "failed" titles."""
+        index = self._storage.view(TitleIndex)
+        report = {"added": [], "failed": {}}
+        names = []
+        for title in titles:
+            if title.strip() == "":
+                continue
+            movie_name = MovieApp.read_movie_name(title)
+            if index.find(movie_name) is not None:
+                report["failed"][movie_name] = "Movie already exists in database"
+            elif movie_name not in names:
+                names.append(movie_name)
+        found = {}
+        found_keys = set()
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for movie_name, (movie_data, reason) in zip(
+                    names, executor.map(self._lookup, names)):
+                if movie_data is None:
+                    report["failed"][movie_name] = reason
+                elif index.find(movie_data["Title"]) is not None or \
+                        normalize(movie_data["Title"]) in found_keys:
+                    report["failed"][movie_name] = "Movie already exists in database"
+                else:
+                    found[movie_data["Title"]] = movie_data
+                    found_keys.add(normalize(movie_data["Title"]))
+        skipped = self._storage.add_movies(
+            (data["Title"], data["Year"], data["imdbRating"], data.get("Poster"))
+            for data in found.values())
+        for title in skipped:
+            report["failed"][title] = "Movie already exists in database"
+        report["added"] = [title for title in found if title not in skipped]
+        return report
+
+    def import_movies(self, file_path):
+        """Imports the titles listed one per line in file_path."""
+        try:
+            with open(file_path, "r", encoding="utf-8") as titles_file:
+                titles = titles_file.read().splitlines()
+        except OSError as error:
+            raise AppError(f"Can not read {file_path}:\n\t--> {error}") from error
+        report = self.add_movies(titles)
+        lines = [f"{len(report['added'])} movies imported, {len(report['failed'])} failed"]
+        lines.extend(f"{title}: {reason}" for title, reason in report["failed"].items())
+        return "\n".join(lines)
+
+    @staticmethod
+    def _movie_lines(movies, start):
+        """Numbered listing lines of (title, info) pairs."""
+        return [f"{x[0]}. {x[1][0]}, Year: {x[1][1]['Year']}, Rating: {x[1][1]['imdbRating']}"
+                for x in enumerate(movies, start=start)]
+
+    def list_movies(self, page_size=None, offset=0):
+        """Returns a list of movies in the database, page_size movies
+        starting at offset. Movies are streamed from the storage and
+        reading stops after the page."""
+        movies = islice(self._storage.iter_movies(), offset,
+                        None if page_size is None else offset + page_size)
+        lines = MovieApp._movie_lines(movies, offset + 1)
+        if not lines:
+            raise AppError("No movies in database" if offset == 0 else "No more movies")
+        return "\n".join(lines)
 
     def delete_movie(self, movie_name: str):
         """Deletes a movie from the database."""
         movie_name = MovieApp.read_movie_name(movie_name)
-        movies = self._storage.list_movies()
-        if movie_name not in movies:
-            raise AppError("Movie doesn't exist in database")
+        if self._storage.get_movie(movie_name) is None:
+            raise MovieNotFoundError("Movie doesn't exist in database")
         self._storage.delete_movie(movie_name)
         return f"Movie {movie_name} deleted successfully"
 
     def update_movie(self, movie_name: str, rating: float):
-        """Updates a movie's rating in the database."""
+        """Updates a movie's rating in the database. nan and inf are
+        rejected before anything is written."""
         movie_name = MovieApp.read_movie_name(movie_name)
-        movies = self._storage.list_movies()
-        if movie_name not in movies:
-            raise AppError("Movie doesn't exist in database")
+        if not isfinite(rating):
+            raise AppError(f"Invalid rating {rating}")
+        if self._storage.get_movie(movie_name) is None:
+            raise MovieNotFoundError("Movie doesn't exist in database")
         self._storage.update_movie(movie_name, rating)
         return f"Movie {movie_name} updated successfully"
 
+    def filter_movies(self, year_from=None, year_to=None, rating_from=None, rating_to=None):
+        """Lists the movies inside the inclusive year and rating ranges,
+        best rated first, None leaves a side open. Runs vectorized when
+        NumPy is installed."""
+        selected = self.columns().filter(year_from, year_to, rating_from, rating_to)
+        if not len(selected):
+            raise AppError("No movies match the filter")
+        lines = [f"{x[0]}. {x[1][0]}, Year: {x[1][1]['Year']}, Rating: {x[1][1]['imdbRating']}"
+                 for x in enumerate(selected.sort(descending=True), start=1)]
+        stats = selected.stats()
+        if stats["count"]:
+            lines.append(f"{len(selected)} movies, average rating {stats['average']:.2f}")
+        return "\n".join(lines)
+
+    def search_movies(self, query, limit=SEARCH_LIMIT):
+        """Lists the stored titles closest to query (typos, missing
+        words, prefixes), best match first."""
+        if query.strip() == "":
+            raise AppError("Please do not leave empty")
+        matches = self._storage.view(TitleIndex).search(query, limit)
+        if not matches:
+            raise AppError(f"No movies match {query.strip()}")
+        return "\n".join(f"{position}. {title} (score {score:.2f})"
+                         for position, (title, score) in enumerate(matches, start=1))
+
     def sort_movies(self):
         """Use movies_storage.py to sort movies."""
         return webCalls.get_sort_movies(self._storage)
@@ -124,29 +283,33 @@ class UserShell:
     Sets user file path for write and read"""
     _registry = os.path.join(SCRIPT_DIR, "registry")
     _write_html = os.path.join(SCRIPT_DIR, "_static")
+    _users = None
+    _users_lock = threading.Lock()
 
     def __init__(self, user_data: dict) -> None:
         self.user_name = user_data["username"].strip().lower()
         self.password = user_data["password"]
 
-    def registry_dir(self):
+    @staticmethod
+    def registry_dir():
         """get registry folder"""
         if not os.path.exists(UserShell._registry):
             os.makedirs(UserShell._registry)
         return UserShell._registry
 
-    def user_registry_folder_dir(self):
-        """get folder path"""
-        registry_folder_path = os.path.join(
-            self.registry_dir(), f'{self.user_name}')
-        if not os.path.exists(registry_folder_path):
-            os.makedirs(registry_folder_path)
-        return registry_folder_path
-
-    def user_registry_path(self):
-        """get registry path"""
-        return os.path.join(
-            self.user_registry_folder_dir(), "registry.json")
+    @classmethod
+    def user_registry(cls) -> UserRegistry:
+        """Returns the shared user registry, opened on first use. Users of
+        the old per user folder layout are migrated into it then."""
+        with cls._users_lock:
+            if cls._users is None:
+                users = UserRegistry(os.path.join(cls.registry_dir(), "users.sqlite3"))
+                try:
+                    users.migrate_folders(cls.registry_dir())
+                except RegistryError as error:
+                    raise UserShellError(str(error)) from error
+                cls._users = users
+        return cls._users
 
     def get_user_movie_path(self):
         """set user movie path"""
@@ -167,28 +330,23 @@ class UserShell:
         return os.path.join(UserShell._write_html, f"{self.user_name}.html")
 
     def generate_user_webpage(self, istorage):
-        """generate user webpage"""
-        return webCalls.create_webpage(self, istorage)
+        """generate user webpage, one page per webCalls.PAGE_SIZE movies"""
+        return webCalls.create_paged_site(self, istorage)
 
     def registry(self) -> str:
-        """Create a user file if it doesn't exist"""
-        user_data = {
-            "username": self.user_name,
-            "password": self.password
-        }
-        with open(self.user_registry_path(), "w", encoding="utf-8") as registry:
-            json.dump(user_data, registry)
+        """Registers the user, raises UserShellError when the name is taken"""
+        try:
+            UserShell.user_registry().add_user(self.user_name, self.password)
+        except RegistryError as error:
+            raise UserShellError(str(error)) from error
         print("NEW USER APPLICATION COMPLETED")
 
     def is_password_correct(self) -> bool:
         """Check user instance password info in registry"""
-        if not os.path.exists(self.user_registry_path()):
-            directory_to_delete = self.user_registry_folder_dir()
-            shutil.rmtree(directory_to_delete)
-            raise UserShellError("User is not registered!! Aborted")
-        with open(self.user_registry_path(), "r", encoding="utf-8") as registry:
-            user_data = json.load(registry)
-        return user_data["password"] == self.password
+        try:
+            return UserShell.user_registry().verify(self.user_name, self.password)
+        except RegistryError as error:
+            raise UserShellError(str(error)) from error
 
 
 def get_name_and_password():
@@ -221,17 +379,40 @@ def checking_sign_info():
 
 
 def get_user_storage(file_extension, user_movie_path):
-    """Get the appropriate user storage based on file extension."""
+    """Get the appropriate user storage based on file extension,
+    instrumented when metrics are enabled."""
+    return metrics.instrument_storage(
+        _open_user_storage(file_extension, user_movie_path))
+
+
+def _open_user_storage(file_extension, user_movie_path):
+    """Opens the storage matching file extension."""
     if file_extension.strip().lower() == "csv":
         return StorageCsv(user_movie_path)
     if file_extension.strip().lower() == "json":
-        return StorageJson(user_movie_path)
+        return StorageJson(user_movie_path, cached=True)
+    if file_extension.strip().lower() == "journal":
+        return StorageJsonJournal(user_movie_path)
+    if file_extension.strip().lower() == "sqlite":
+        return StorageSqlite(user_movie_path)
+    if file_extension.strip().lower() == "mmap":
+        from storage_mmap import StorageMmap
+        return StorageMmap(user_movie_path)
     raise UserShellError("File extension is not valid!! Aborted")
 
 
 def perform_movie_operation(user, user_storage, operation, command):
     """Perform the selected movie operation."""
-    if command == 3:
+    if command == 1:
+        offset = 0
+        while True:
+            page = operation[command](LIST_PAGE_SIZE, offset)
+            print(f"\n{page}\n")
+            offset += LIST_PAGE_SIZE
+            if page.count("\n") + 1 < LIST_PAGE_SIZE or \
+                    not io.ask_to_continue("Show the next page y/n: "):
+                break
+    elif command == 3:
         movie_name = io.read_text("Enter a movie name: ")
         print(f"\n{operation[command](movie_name)}\n")
     elif command == 4:
@@ -240,6 +421,17 @@ def perform_movie_operation(user, user_storage, operation, command):
         print(f"\n{operation[command](movie_name, new_rating)}\n")
     elif command == 7:
         print(f"\n{user.generate_user_webpage(user_storage)}\n")
+    elif command == 8:
+        file_path = io.read_text("Enter the path of a file with one title per line: ")
+        print(f"\n{operation[command](file_path)}\n")
+    elif command == 9:
+        query = io.read_text("Enter a title to search: ")
+        print(f"\n{operation[command](query)}\n")
+    elif command == 10:
+        bounds = [io.read_optional_number(f"{prompt} (press enter for any): ", function)
+                  for prompt, function in (("Year from", int), ("Year to", int),
+                                           ("Rating from", float), ("Rating to", float))]
+        print(f"\n{operation[command](*bounds)}\n")
     else:
         print(f"\n{operation[command]()}\n")
 
@@ -252,7 +444,7 @@ def user_menu():
         # Assigns UserShell instance to user variable
         user = checking_sign_info()
         file_extension = io.read_text(
-            "Please enter file extension (json/csv): ")
+            "Please enter file extension (json/journal/csv/sqlite/mmap): ")
         user_movie_path = user.get_user_movie_path()
         # Assigns StorageJson or StorageCsv instance to user_storage variable
         user_storage = get_user_storage(file_extension, user_movie_path)
@@ -267,7 +459,10 @@ def user_menu():
             5: user_app.sort_movies,
             6: user_app.stat_movies,
             7: user.generate_user_webpage,
-            8: "exit"
+            8: user_app.import_movies,
+            9: user_app.search_movies,
+            10: user_app.filter_movies,
+            11: "exit"
         }
 
         # exclude_functions = []
@@ -295,8 +490,46 @@ def user_menu():
         print(f"Application terminated\n\t--> {error}")
 
 
+def startup_profile(module="movie_user_app", limit=15):
+    """Imports module in a fresh interpreter with -X importtime and
+    returns a report of the total, the modules it imports directly and
+    the slowest modules by their own import time."""
+    import subprocess
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=SCRIPT_DIR, capture_output=True, text=True, check=False)
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((name.strip(), depth, int(own) / 1000, int(cumulative) / 1000))
+    if result.returncode or not entries:
+        return f"Import of {module} failed:\n{result.stderr[-2000:]}"
+    # children are reported before their parent
+    end = max(index for index, entry in enumerate(entries) if entry[0] == module)
+    start = end
+    while start and entries[start - 1][1] > entries[end][1]:
+        start -= 1
+    subtree = entries[start:end + 1]
+    startup = sum(entry[3] for entry in entries[:start] if entry[1] == 0)
+    lines = [f"Import of {module}: {entries[end][3]:.1f} ms, {len(subtree)} modules",
+             f"Interpreter startup before it (site, .pth files): {startup:.1f} ms",
+             "", "Direct imports (cumulative ms):"]
+    lines.extend(f"  {cumulative:8.1f}  {name}"
+                 for name, depth, own, cumulative in sorted(
+                     (entry for entry in subtree if entry[1] == 1), key=lambda entry: -entry[3]))
+    lines.extend(["", f"Slowest {limit} modules (own ms):"])
+    lines.extend(f"  {own:8.1f}  {name}" for name, depth, own, cumulative in
+                 sorted(subtree, key=lambda entry: -entry[2])[:limit])
+    return "\n".join(lines)
+
+
 def main():
-    """main function"""
+    """main function, --startup-profile prints the import time report"""
+    if "--startup-profile" in sys.argv[1:]:
+        print(startup_profile())
+        return
     user_menu()
 
 
@@ -0,0 +1,258 @@
+"""In memory structures derived from a storage and kept up to date on
+every add, delete and update instead of being rebuilt per call."""
+import threading
+from contextlib import contextmanager
+from bisect import bisect_left, bisect_right, insort
+from math import ceil, isfinite
+from operator import itemgetter
+
+UNRATED = float("-inf")
+
+
+def parse_rating(rating):
+    """Returns rating as float, UNRATED when it isn't a finite number
+    (e.g. "N/A", nan or inf, which would break the bisect order)."""
+    try:
+        rating = float(rating)
+    except (TypeError, ValueError):
+        return UNRATED
+    return rating if isfinite(rating) else UNRATED
+
+
+class MovieView:
+    """Base class of the views. A view is attached to one storage with
+    IStorage.view(), built from list_movies() on first use and then fed
+    every mutation through movie_changed(). When the storage signature
+    shows a write the view didn't see (another process), it is rebuilt.
+    Subclass queries run under self._reading() so concurrent readers don't
+    rebuild the same view at once. The storage read lock is taken before
+    the view lock, the order mutators take them in too."""
+
+    def __init__(self, storage):
+        self._storage = storage
+        self._signature = None
+        self._built = False
+        self._lock = threading.RLock()
+
+    def reset(self):
+        """Drops every entry."""
+        raise NotImplementedError
+
+    def add(self, title, info):
+        """Adds a movie."""
+        raise NotImplementedError
+
+    def remove(self, title):
+        """Removes a movie."""
+        raise NotImplementedError
+
+    def update(self, title, changes):
+        """Applies changed fields (e.g. {"imdbRating": 8.1}) to a movie."""
+        raise NotImplementedError
+
+    @contextmanager
+    def _reading(self):
+        """Holds the storage read lock and the view lock."""
+        with self._storage._read_lock(), self._lock:
+            yield
+
+    def refresh(self):
+        """Rebuilds the view when it was never built or is stale."""
+        with self._reading():
+            signature = self._storage.signature()
+            if self._built and signature == self._signature:
+                return
+            self.reset()
+            for title, info in self._storage.list_movies().items():
+                self.add(title, info)
+            self._built = True
+            self._signature = signature
+
+    def invalidate(self):
+        """Rebuilds the view on next use."""
+        self._built = False
+
+    def signature_moved(self, before, after):
+        """Accepts a new storage signature for data the view already has."""
+        if self._built and self._signature == before:
+            self._signature = after
+
+    def movie_changed(self, method, args, result, before):
+        """Called after a storage mutator returned. before is the storage
+        signature taken before the call, a mismatch means the view missed
+        a write and has to be rebuilt."""
+        with self._lock:
+            if not self._built:
+                return
+            if before != self._signature:
+                self._built = False
+                return
+            if method == "add_movie":
+                title, year, rating, poster = args
+                self.add(title, {"Year": year, "imdbRating": rating, "Poster": poster})
+            elif method == "add_movies":
+                skipped = set(result or ())
+                for title, year, rating, poster in args[0]:
+                    if title not in skipped:
+                        self.add(title, {"Year": year, "imdbRating": rating, "Poster": poster})
+            elif method == "delete_movie":
+                self.remove(args[0])
+            elif method == "update_movie":
+                self.update(args[0], {"imdbRating": args[1]})
+            self._signature = self._storage.signature()
+
+
+class RatingIndex(MovieView):
+    """Titles ordered by rating, kept sorted with bisect so top-k, rating
+    ranges and pages are answered without sorting the library."""
+
+    def reset(self):
+        self._keys = []
+        self._movies = {}
+
+    def add(self, title, info):
+        if title in self._movies:
+            self.remove(title)
+        rating = parse_rating(info.get("imdbRating"))
+        self._movies[title] = (rating, info.get("Year"), info.get("imdbRating"))
+        insort(self._keys, (rating, title))
+
+    def remove(self, title):
+        movie = self._movies.pop(title, None)
+        if movie is None:
+            return
+        position = bisect_left(self._keys, (movie[0], title))
+        del self._keys[position]
+
+    def update(self, title, changes):
+        movie = self._movies.get(title)
+        if movie is not None and "imdbRating" in changes:
+            self.add(title, {"Year": movie[1], "imdbRating": changes["imdbRating"]})
+
+    def _entry(self, key):
+        """Converts an index key to a (title, info) pair."""
+        movie = self._movies[key[1]]
+        return key[1], {"Year": movie[1], "imdbRating": movie[2]}
+
+    def __len__(self):
+        with self._reading():
+            self.refresh()
+            return len(self._keys)
+
+    def page(self, offset=0, limit=None, descending=False):
+        """Returns limit (title, info) pairs starting at offset."""
+        with self._reading():
+            self.refresh()
+            size = len(self._keys)
+            stop = size if limit is None else min(size, offset + limit)
+            if descending:
+                keys = (self._keys[size - 1 - position] for position in range(offset, stop))
+            else:
+                keys = (self._keys[position] for position in range(offset, stop))
+            return [self._entry(key) for key in keys]
+
+    def top(self, count):
+        """Returns the count best rated movies."""
+        return self.page(0, count, descending=True)
+
+    def between(self, low, high, descending=False):
+        """Returns the movies rated from low to high inclusive."""
+        with self._reading():
+            self.refresh()
+            start = bisect_left(self._keys, low, key=itemgetter(0))
+            stop = bisect_right(self._keys, high, key=itemgetter(0))
+            keys = self._keys[start:stop]
+            if descending:
+                keys.reverse()
+            return [self._entry(key) for key in keys]
+
+
+class RatingStats(MovieView):
+    """Running count, sum and a histogram of ratings (0.1 wide buckets)
+    overall and per year, so statistics are read without a scan. Every
+    bucket also counts its exact ratings, so min, max and percentiles are
+    exact. Unrated movies are left out."""
+
+    def reset(self):
+        self._movies = {}
+        self._count = 0
+        self._sum = 0.0
+        self._histogram = {}
+        self._values = {}
+        self._years = {}
+
+    def _change(self, title, sign):
+        """Adds (sign 1) or removes (sign -1) title's rating."""
+        rating, year = self._movies[title]
+        if rating == UNRATED:
+            return
+        bucket = round(rating * 10)
+        self._count += sign
+        self._sum += sign * rating
+        self._histogram[bucket] = self._histogram.get(bucket, 0) + sign
+        values = self._values.setdefault(bucket, {})
+        values[rating] = values.get(rating, 0) + sign
+        if not values[rating]:
+            del values[rating]
+        if not self._histogram[bucket]:
+            del self._histogram[bucket]
+            del self._values[bucket]
+        year_stats = self._years.setdefault(year, [0, 0.0])
+        year_stats[0] += sign
+        year_stats[1] += sign * rating
+        if not year_stats[0]:
+            del self._years[year]
+
+    def add(self, title, info):
+        if title in self._movies:
+            self.remove(title)
+        self._movies[title] = (parse_rating(info.get("imdbRating")), info.get("Year"))
+        self._change(title, 1)
+
+    def remove(self, title):
+        if title in self._movies:
+            self._change(title, -1)
+            del self._movies[title]
+
+    def update(self, title, changes):
+        if title in self._movies and "imdbRating" in changes:
+            self.add(title, {"Year": self._movies[title][1],
+                             "imdbRating": changes["imdbRating"]})
+
+    def percentile(self, percent):
+        """Nearest rank percentile of the ratings, None when empty."""
+        with self._reading():
+            self.refresh()
+            if not self._count:
+                return None
+            rank = max(1, ceil(percent / 100 * self._count))
+            seen = 0
+            for bucket in sorted(self._histogram):
+                if seen + self._histogram[bucket] < rank:
+                    seen += self._histogram[bucket]
+                    continue
+                values = self._values[bucket]
+                for rating in sorted(values):
+                    seen += values[rating]
+                    if seen >= rank:
+                        return rating
+            return None
+
+    def summary(self):
+        """Returns count, max, min, average and median of the ratings."""
+        with self._reading():
+            self.refresh()
+            if not self._count:
+                return {"count": 0, "max": None, "min": None,
+                        "average": None, "median": None}
+            return {"count": self._count, "max": max(self._values[max(self._histogram)]),
+                    "min": min(self._values[min(self._histogram)]),
+                    "average": self._sum / self._count,
+                    "median": self.percentile(50)}
+
+    def by_year(self):
+        """Returns {year: (count, average rating)}."""
+        with self._reading():
+            self.refresh()
+            return {year: (count, total / count)
+                    for year, (count, total) in self._years.items()}
@@ -1,9 +1,24 @@
-"""Methods for stored objects in a file."""
-import requests
-from storage import json
+"""Methods for stored objects in a file.
+The network stack (requests, http_client) and the response cache are
+imported on the first lookup, sessions working on local data never
+load them."""
+import threading
+from storage import json, os, file_signature, atomic_write
+from movie_record import movies_by_title
+import metrics
 
 YOUR_API_KEY = "ae98550b"
-BASE_URL = "http://www.omdbapi.com"
+# OMDB_BASE_URL points lookups to another server, e.g. a local stub
+BASE_URL = os.environ.get("OMDB_BASE_URL", "http://www.omdbapi.com")
+CACHE_PATH = os.environ.get("OMDB_CACHE_PATH", os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), ".cache", "omdb.sqlite3"))
+CACHE_TTL = int(os.environ.get("OMDB_CACHE_TTL", 7 * 24 * 3600))
+CACHE_NEGATIVE_TTL = int(os.environ.get("OMDB_CACHE_NEGATIVE_TTL", 24 * 3600))
+CACHE_MAX_ENTRIES = int(os.environ.get("OMDB_CACHE_MAX_ENTRIES", 10000))
+PAGE_SIZE = 100
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
 
 
 class FunctionErrors(Exception):
@@ -29,17 +44,53 @@ def get_name_method_requests(method_name: str, movie_name: str) -> str:
     return None
 
 
-def get_by_name(movie_name: str) -> dict:
+def get_response_cache():
+    """Returns the shared OMDb response_cache.ResponseCache, opened on first use."""
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            from response_cache import ResponseCache
+            _response_cache = ResponseCache(
+                CACHE_PATH, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES,
+                negative_ttl=CACHE_NEGATIVE_TTL)
+            cache = _response_cache
+            metrics.REGISTRY.add_collector(lambda: {
+                f"movie_omdb_cache_{name}": value for name, value in cache.stats().items()})
+    return _response_cache
+
+
+def get_by_name(movie_name: str, use_cache: bool = True) -> dict:
     """get_by_name is a method that returns a dict.
+    Answers are served from the response cache when possible.
     Args:
         movie_name (str): given string by user.
+        use_cache (bool): False always asks OMDb.
     Returns:
         parsed_data: returns dictionary of movie.
     """
+    if use_cache:
+        found, parsed_data = get_response_cache().get(movie_name)
+        if found and parsed_data is None:
+            raise FunctionErrors(
+                f"Entered movie name: {movie_name} has no response")
+        if found:
+            return parsed_data
+    parsed_data = _request_by_name(movie_name, use_cache)
+    if use_cache and parsed_data is not None:
+        get_response_cache().put(movie_name, parsed_data)
+    return parsed_data
+
+
+@metrics.timed("movie_omdb_request")
+def _request_by_name(movie_name: str, use_cache: bool) -> dict:
+    """Asks OMDb for movie_name, a Response: False answer is cached
+    as negative before FunctionErrors is raised."""
+    import requests
+    import http_client
     request_api = get_name_method_requests("name", movie_name)
     if request_api is not None:
         try:
-            response = requests.get(request_api, timeout=5)
+            response = http_client.get_client().get(request_api, read_timeout=5)
             parsed_data = json.loads(response.text)
             # Check for HTTP error status codes
             response.raise_for_status()
@@ -47,6 +98,8 @@ def get_by_name(movie_name: str) -> dict:
             title_status = parsed_data.get("Title", "Unknown")
             # Unvalid user text returns Response: False
             if not response_status == "True" or title_status == "Unknown":
+                if use_cache and response_status == "False":
+                    get_response_cache().put(movie_name, None)
                 raise FunctionErrors(
                     f"Entered movie name: {movie_name} has no response")
             return parsed_data
@@ -56,21 +109,26 @@ def get_by_name(movie_name: str) -> dict:
     return None
 
 
-def get_sort_movies(instance):
+def get_sort_movies(instance, order=None, limit=None):
     """
     Sorts the movies database.
-    Loads the information from the file, sorts the movies,
-    The function doesn't need to validate the input.
+    Without an order the user is asked the order and how many movies to
+    show, a None limit shows every movie. Only the requested movies are
+    taken from the storage.
     """
-    data = instance.list_movies()
     valid_entries = {"asc": False, "desc": True}
-    user_choice = input("Enter the order of sorting 'asc' or 'desc': ")
-    if not user_choice.strip().lower() in valid_entries:
+    if order is None:
+        order = input("Enter the order of sorting 'asc' or 'desc': ")
+        limit = input("How many movies to show (press enter for all): ").strip()
+        if limit and not limit.isdigit():
+            raise FunctionErrors("Invalid number of movies")
+        limit = int(limit) if limit else None
+    order = order.strip().lower()
+    if not order in valid_entries:
         raise FunctionErrors("Invalid sorting input")
 
-    sorted_movies = sorted(
-        data.items(), key=lambda x: float(x[1]['imdbRating']),
-        reverse=valid_entries[user_choice])
+    sorted_movies = instance.sort_movies(
+        descending=valid_entries[order], limit=limit)
     return "\n".join(
         f"{item[0]}. {item[1][0]}, Year: {item[1][1]['Year']}, Rating: {item[1][1]['imdbRating']}"
         for item in enumerate(sorted_movies, start=1))
@@ -78,26 +136,19 @@ def get_sort_movies(instance):
 
 def get_stat_movies(instance):
     """
-    Returns a dictionary of dictionaries that
-    contains the movies information in the database.
+    Returns the rating statistics of the movies in the database.
+    Raises FunctionErrors when there is no rated movie.
     """
-    data = instance.list_movies()
-    max_rating = max(data.values(), key=lambda x: float(x['imdbRating']))
-    min_rating = min(data.values(), key=lambda x: float(x['imdbRating']))
-    average_rating = sum(float(item['imdbRating'])
-                         for item in data.values()) / len(data)
-
-    return f"""Max rating: {max_rating['imdbRating']}
-Min rating: {min_rating['imdbRating']}
-Average rating: {average_rating:.2f}"""
+    stats = instance.rating_stats()
+    if not stats["count"]:
+        raise FunctionErrors("No rated movies in database")
+    return f"""Max rating: {stats['max']}
+Min rating: {stats['min']}
+Average rating: {stats['average']:.2f}
+Median rating: {stats['median']}"""
 
 
-def create_movies_list_html(movies):
-    """Create a list of movies in html format"""
-    # target = "__TEMPLATE_MOVIE_GRID__"
-    html_code = []
-    for key, value in movies.items():
-        template = '''<li>
+MOVIE_TEMPLATE = '''<li>
             <div class="movie">
                 <img class="movie-poster"
                      src={poster}
@@ -106,34 +157,216 @@ def create_movies_list_html(movies):
                 <div class="movie-year">{year}</div>
             </div>
         </li>'''
-        title = key
-        year = value["Year"]
-        poster = value["Poster"]
 
-        template = template.format(
-            poster=poster, title=title, year=year)
-        html_code.append(template)
-    return "\n".join(html_code)
+# template path -> (file signature, head, tail)
+_template_cache = {}
+
+
+def render_movie_fragments(movies, posters=None):
+    """Returns the <li> fragment of every movie. posters maps poster urls
+    to local files (see poster_cache), other posters keep their url."""
+    posters = posters or {}
+    return [MOVIE_TEMPLATE.format(poster=posters.get(value["Poster"], value["Poster"]),
+                                  title=key, year=value["Year"])
+            for key, value in movies.items()]
+
+
+def create_movies_list_html(movies):
+    """Create a list of movies in html format"""
+    return "\n".join(render_movie_fragments(movies))
+
+
+def compile_template(template_path):
+    """Reads the template once and returns (head, tail) around the movie
+    grid with the title placeholders already replaced. The result is
+    reused until the template file changes."""
+    signature = file_signature(template_path)
+    cached = _template_cache.get(template_path)
+    if cached is not None and cached[0] == signature:
+        return cached[1], cached[2]
+    with open(template_path, "r", encoding="utf-8") as template_file:
+        source_html = template_file.read()
+    source_html = source_html.replace("My Movie App", "RAVEN MACIUS")
+    source_html = source_html.replace("__TEMPLATE_TITLE__", "MY MOVIE DATABASE")
+    head, _, tail = source_html.partition("__TEMPLATE_MOVIE_GRID__")
+    _template_cache[template_path] = (signature, head, tail)
+    return head, tail
 
 
 def replace_in_html(user, replacement):
-    """Replace target in html file with replacement"""
-
-    with open(user.get_html_index(), "r", encoding="utf-8") as current_html:
-        with open(user.get_updated_path(), "w", encoding="utf-8") as new_html:
-            source_html = current_html.read()
-            updated_html = source_html.replace(
-                "My Movie App", "RAVEN MACIUS")
-            updated_html = updated_html.replace(
-                "__TEMPLATE_TITLE__", "MY MOVIE DATABASE")
-            updated_html = updated_html.replace(
-                "__TEMPLATE_MOVIE_GRID__", replacement)
-            new_html.write(updated_html)
-
-
-def create_webpage(user, instance):
-    """Main generate user webpage function"""
-    movies_data = instance.list_movies()
-    html_str = create_movies_list_html(movies_data)
-    replace_in_html(user, html_str)
-    return "HTML file created successfully"
+    """Replace target in html file with replacement.
+    replacement is a string or a list of fragments joined by new lines.
+    The page is streamed to a temporary file and renamed into place
+    (storage.atomic_write), so concurrent writers never share a file."""
+    head, tail = compile_template(user.get_html_index())
+    if isinstance(replacement, str):
+        replacement = [replacement]
+
+    def write(new_html):
+        new_html.write(head)
+        for index, fragment in enumerate(replacement):
+            if index:
+                new_html.write("\n")
+            new_html.write(fragment)
+        new_html.write(tail)
+    atomic_write(user.get_updated_path(), write, encoding="utf-8")
+
+
+def _poster_sources(user, movies_data):
+    """Downloads the missing posters of movies_data to the poster cache,
+    returns ({url: local src}, report text)."""
+    from poster_cache import get_poster_cache
+    cache = get_poster_cache()
+    urls = [record.poster for record in movies_data.values()]
+    fetched = cache.prefetch(urls)
+    posters = cache.sources(urls, os.path.dirname(user.get_updated_path()))
+    return posters, (f" ({fetched['fetched']} posters downloaded, {fetched['cached']} cached, "
+                     f"{fetched['failed'] + fetched['skipped']} failed)")
+
+
+def create_webpage(user, instance, local_posters=True):
+    """Main generate user webpage function.
+    With local_posters the posters are downloaded to the poster cache
+    first and the page points to the local copies."""
+    movies_data = movies_by_title(instance.list_records())
+    posters = None
+    report = ""
+    if local_posters:
+        posters, report = _poster_sources(user, movies_data)
+    replace_in_html(user, render_movie_fragments(movies_data, posters))
+    return "HTML file created successfully" + report
+
+
+PAGE_NAV_TEMPLATE = '''<nav class="page-nav">
+      <a href="{index}">Index</a>{previous}
+      <span>Page {number} of {count}</span>{next}
+    </nav>'''
+PAGE_LINK_TEMPLATE = '''<li class="page-link">
+            <a href="{file}">Page {number}</a>
+            <div class="movie-title">{first} &ndash; {last}</div>
+        </li>'''
+
+
+def page_file_name(stem, number):
+    """File name of page number (from 1) of a paged site."""
+    return f"{stem}-page-{number:04d}.html"
+
+
+def _page_nav(stem, number, count):
+    """Index / previous / next links of a page."""
+    previous = next_page = ""
+    if number > 1:
+        previous = f'\n      <a href="{page_file_name(stem, number - 1)}">Previous</a>'
+    if number < count:
+        next_page = f'\n      <a href="{page_file_name(stem, number + 1)}">Next</a>'
+    return PAGE_NAV_TEMPLATE.format(index=f"{stem}.html", previous=previous,
+                                    number=number, count=count, next=next_page)
+
+
+def _with_nav(head, tail, nav):
+    """Puts nav at the top and the bottom of the page body."""
+    return head.replace("<body>", "<body>\n    " + nav, 1), \
+        tail.replace("</body>", "  " + nav + "\n  </body>", 1)
+
+
+def _brotli():
+    """Returns brotli, imported on first use, None when it isn't installed
+    (pages get only a .gz sibling)."""
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def _write_page(path, text, entry):
+    """Writes a page and its compressed siblings when its content hash
+    differs from entry (the manifest entry of the last run). Returns the
+    new manifest entry and whether the files were written."""
+    import gzip
+    import hashlib
+    brotli = _brotli()
+    data = text.encode("utf-8")
+    digest = hashlib.sha256(data).hexdigest()
+    siblings = [path + ".gz"] + ([path + ".br"] if brotli is not None else [])
+    if entry is not None and entry.get("sha256") == digest and \
+            all(os.path.exists(file_path) for file_path in [path] + siblings):
+        return entry, False
+    atomic_write(path, lambda page_file: page_file.write(data), mode="wb")
+    # mtime=0 keeps the .gz of an unchanged page byte for byte identical
+    compressed = gzip.compress(data, compresslevel=9, mtime=0)
+    atomic_write(path + ".gz", lambda page_file: page_file.write(compressed), mode="wb")
+    if brotli is not None:
+        compressed = brotli.compress(data, mode=brotli.MODE_TEXT)
+        atomic_write(path + ".br", lambda page_file: page_file.write(compressed), mode="wb")
+    return {"sha256": digest, "bytes": len(data)}, True
+
+
+def _remove_page(path):
+    """Removes a page that is no longer part of the site."""
+    for file_path in (path, path + ".gz", path + ".br"):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+def create_paged_site(user, instance, page_size=PAGE_SIZE, local_posters=True):
+    """Writes the library as <user>-page-NNNN.html pages of page_size
+    movies with index/previous/next links, an index page <user>.html and
+    a <user>-pages.json manifest. Every page gets a .gz sibling (and a
+    .br one when brotli is installed) for static servers that send
+    precompressed files. Only pages whose content changed are written."""
+    import html
+    if page_size < 1:
+        raise FunctionErrors("Invalid page size")
+    movies_data = movies_by_title(instance.list_records())
+    posters = None
+    report = ""
+    if local_posters:
+        posters, report = _poster_sources(user, movies_data)
+    head, tail = compile_template(user.get_html_index())
+    index_path = user.get_updated_path()
+    folder = os.path.dirname(index_path)
+    stem = os.path.splitext(os.path.basename(index_path))[0]
+    manifest_path = os.path.join(folder, f"{stem}-pages.json")
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as manifest_file:
+            previous = json.load(manifest_file)
+    except (OSError, ValueError):
+        previous = {}
+    previous_pages = {page["file"]: page for page in previous.get("pages", [])}
+
+    titles = list(movies_data)
+    fragments = render_movie_fragments(movies_data, posters)
+    count = max(1, -(-len(titles) // page_size))
+    pages, links, written = [], [], 0
+    for number in range(1, count + 1):
+        start = (number - 1) * page_size
+        stop = start + page_size
+        file_name = page_file_name(stem, number)
+        page_head, page_tail = _with_nav(head, tail, _page_nav(stem, number, count))
+        entry, changed = _write_page(
+            os.path.join(folder, file_name),
+            page_head + "\n".join(fragments[start:stop]) + page_tail,
+            previous_pages.get(file_name))
+        written += changed
+        first, last = (titles[start], titles[min(stop, len(titles)) - 1]) \
+            if titles else ("", "")
+        pages.append({"file": file_name, "number": number, "movies": len(titles[start:stop]),
+                      "first": first, "last": last, **entry})
+        links.append(PAGE_LINK_TEMPLATE.format(file=file_name, number=number,
+                                               first=html.escape(first), last=html.escape(last)))
+    index_entry, changed = _write_page(index_path, head + "\n".join(links) + tail,
+                                       previous.get("index"))
+    written += changed
+    for file_name in previous_pages.keys() - {page["file"] for page in pages}:
+        _remove_page(os.path.join(folder, file_name))
+
+    manifest = {"page_size": page_size, "movies": len(titles),
+                "index": {"file": os.path.basename(index_path), **index_entry},
+                "pages": pages}
+    if manifest != previous:
+        atomic_write(manifest_path,
+                     lambda manifest_file: json.dump(manifest, manifest_file, indent=1),
+                     encoding="utf-8")
+    return (f"HTML site created successfully: {count} pages, {written} pages written"
+            + report)
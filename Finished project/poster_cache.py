@@ -0,0 +1,208 @@
+"""Local copies of the movie posters for the generated webpages.
+
+Posters are downloaded once, concurrently, and stored under their content
+hash in _static/posters/<hash[:2]>/<hash>.<ext>, so the same image reached
+by several urls is stored once. With Pillow installed a thumbnail of
+THUMB_SIZE is made next to it and used in the page, without Pillow the
+page shows the original. manifest.json maps every fetched url to its
+file, later runs only download urls that aren't in it. Failed downloads
+are recorded too and not retried for FAILED_TTL seconds."""
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from storage import atomic_write, json
+import ioput as io
+import metrics
+
+try:
+    from PIL import Image
+except ImportError:  # optional, pages use the full size posters
+    Image = None
+
+POSTER_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "_static", "posters")
+POSTER_WORKERS = 8
+THUMB_SIZE = (200, 300)
+# seconds before a failed url is requested again
+FAILED_TTL = 24 * 3600
+EXTENSIONS = {"image/jpeg": ".jpg", "image/png": ".png", "image/gif": ".gif",
+              "image/webp": ".webp"}
+
+_poster_cache = None
+_poster_cache_lock = threading.Lock()
+
+
+def is_remote(url):
+    """Checks whether url is a downloadable poster ("N/A" and empty
+    values aren't)."""
+    return isinstance(url, str) and url.startswith(("http://", "https://"))
+
+
+def _extension(url, content_type):
+    """File extension of a poster from its content type or its url."""
+    extension = EXTENSIONS.get((content_type or "").split(";")[0].strip().lower())
+    if extension is None:
+        extension = os.path.splitext(url.split("?")[0])[1].lower()
+        if extension not in EXTENSIONS.values():
+            extension = ".jpg"
+    return extension
+
+
+class PosterCache:
+    """Content addressed poster files and the url -> file manifest.
+    Paths in the manifest are relative to the cache folder, failed urls
+    map to {"failed": time of the attempt}."""
+
+    def __init__(self, folder=POSTER_DIR, workers=POSTER_WORKERS, thumb_size=THUMB_SIZE,
+                 failed_ttl=FAILED_TTL):
+        self._folder = folder
+        self._workers = workers
+        self._thumb_size = thumb_size
+        self._failed_ttl = failed_ttl
+        self._manifest_path = os.path.join(folder, "manifest.json")
+        self._lock = threading.Lock()
+        self._manifest = {}
+        if os.path.exists(self._manifest_path):
+            try:
+                with open(self._manifest_path, "r", encoding="utf-8") as manifest_file:
+                    self._manifest = json.load(manifest_file)
+            except (OSError, ValueError):
+                self._manifest = {}
+
+    @property
+    def folder(self):
+        """Folder of the cached posters."""
+        return self._folder
+
+    def _cached(self, url):
+        """Returns the manifest entry of url when its files still exist."""
+        entry = self._manifest.get(url)
+        if entry is None or "file" not in entry:
+            return None
+        if not all(os.path.exists(os.path.join(self._folder, entry[name]))
+                   for name in ("file", "thumb")):
+            return None
+        return entry
+
+    def _failed_recently(self, url):
+        """Checks whether downloading url failed less than failed_ttl ago."""
+        entry = self._manifest.get(url)
+        return entry is not None and "failed" in entry and \
+            time.time() - entry["failed"] < self._failed_ttl
+
+    def _store(self, url, content, content_type):
+        """Writes a downloaded poster and its thumbnail, returns the
+        manifest entry. Files already stored under the hash are kept."""
+        digest = hashlib.sha256(content).hexdigest()
+        name = os.path.join(digest[:2], digest + _extension(url, content_type))
+        path = os.path.join(self._folder, name)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            atomic_write(path, lambda poster_file: poster_file.write(content), mode="wb")
+        entry = {"file": name, "thumb": name}
+        if Image is not None:
+            width, height = self._thumb_size
+            thumb = os.path.join(digest[:2], f"{digest}-{width}x{height}.jpg")
+            thumb_path = os.path.join(self._folder, thumb)
+            try:
+                if not os.path.exists(thumb_path):
+                    with Image.open(path) as image:
+                        image.thumbnail(self._thumb_size)
+                        atomic_write(thumb_path, lambda thumb_file: image.convert("RGB").save(
+                            thumb_file, "JPEG", quality=85, optimize=True), mode="wb")
+                entry["thumb"] = thumb
+            except (OSError, ValueError):  # not an image Pillow reads, use the original
+                pass
+        return entry
+
+    def _fetch(self, url):
+        """Downloads one poster, returns its manifest entry or None."""
+        response = io.page_request(url)
+        if response is None:
+            return None
+        try:
+            content = response.content
+            if not content:
+                return None
+            return self._store(url, content, response.headers.get("Content-Type"))
+        finally:
+            response.close()
+
+    def prefetch(self, urls):
+        """Downloads the posters of urls that aren't cached yet with at most
+        workers requests in flight. Urls that failed within failed_ttl are
+        skipped. Returns a report dictionary with the "fetched", "cached",
+        "failed" and "skipped" counts."""
+        report = {"fetched": 0, "cached": 0, "failed": 0, "skipped": 0}
+        missing = []
+        for url in dict.fromkeys(urls):
+            if not is_remote(url):
+                continue
+            if self._cached(url) is not None:
+                report["cached"] += 1
+            elif self._failed_recently(url):
+                report["skipped"] += 1
+            else:
+                missing.append(url)
+        if missing:
+            with ThreadPoolExecutor(max_workers=self._workers) as executor:
+                for url, entry in zip(missing, executor.map(self._fetch, missing)):
+                    if entry is None:
+                        entry = {"failed": time.time()}
+                        report["failed"] += 1
+                    else:
+                        report["fetched"] += 1
+                    with self._lock:
+                        self._manifest[url] = entry
+            self.save()
+        for name, value in report.items():
+            metrics.count(f"movie_posters_{name}_total", value)
+        return report
+
+    def save(self):
+        """Writes the manifest, merged with the entries another process
+        may have written meanwhile. A poster another process fetched wins
+        over a failure recorded here."""
+        manifest = {}
+        try:
+            with open(self._manifest_path, "r", encoding="utf-8") as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            pass
+        with self._lock:
+            manifest.update((url, entry) for url, entry in self._manifest.items()
+                            if "file" in entry or "file" not in manifest.get(url, {}))
+            self._manifest = manifest
+            manifest = dict(manifest)
+        os.makedirs(self._folder, exist_ok=True)
+        atomic_write(self._manifest_path,
+                     lambda manifest_file: json.dump(manifest, manifest_file, indent=1),
+                     encoding="utf-8")
+
+    def local_path(self, url, thumbnail=True):
+        """Returns the path of the cached poster (or its thumbnail) of url,
+        None when it isn't cached."""
+        entry = self._cached(url)
+        if entry is None:
+            return None
+        return os.path.join(self._folder, entry["thumb" if thumbnail else "file"])
+
+    def sources(self, urls, page_folder):
+        """Returns {url: src} for the cached posters of urls, src being
+        relative to page_folder (the folder of the html file)."""
+        sources = {}
+        for url in urls:
+            path = self.local_path(url)
+            if path is not None:
+                sources[url] = os.path.relpath(path, page_folder).replace(os.sep, "/")
+        return sources
+
+
+def get_poster_cache():
+    """Returns the shared PosterCache of _static/posters."""
+    global _poster_cache
+    with _poster_cache_lock:
+        if _poster_cache is None:
+            _poster_cache = PosterCache()
+        return _poster_cache
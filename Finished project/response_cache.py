@@ -0,0 +1,127 @@
+"""Persistent cache for OMDb responses shared by every user on the host."""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """On disk (sqlite) cache of OMDb responses keyed by normalized title.
+    Entries expire after ttl seconds, negative entries (Response: False)
+    after negative_ttl seconds. When more than max_entries are stored the
+    least recently used ones are evicted. A small in memory layer serves
+    repeated lookups of the same process without touching the database."""
+
+    # last access times are only written back when older than this
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, file_path, ttl=7 * 24 * 3600, max_entries=10000,
+                 negative_ttl=24 * 3600, memory_entries=1024):
+        folder = os.path.dirname(file_path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._max_entries = max_entries
+        self._memory_entries = memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "negative_hits": 0,
+                          "stores": 0, "evictions": 0}
+        self._connection = sqlite3.connect(file_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "title TEXT PRIMARY KEY, payload TEXT, stored REAL, accessed REAL)")
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed)")
+
+    @staticmethod
+    def normalize(title):
+        """Lower case title with collapsed white space."""
+        return " ".join(title.lower().split())
+
+    def _expired(self, payload, stored, now):
+        """Checks the age of an entry against its ttl."""
+        ttl = self._negative_ttl if payload is None else self._ttl
+        return now - stored > ttl
+
+    def _remember(self, key, entry):
+        """Keeps entry in the in memory layer."""
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, title):
+        """Returns (found, response). response is None for a cached
+        negative answer. Expired entries count as misses."""
+        key = self.normalize(title)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                row = self._connection.execute(
+                    "SELECT payload, stored, accessed FROM responses WHERE title = ?",
+                    (key,)).fetchone()
+                entry = list(row) if row else None
+            if entry is None or self._expired(entry[0], entry[1], now):
+                self._memory.pop(key, None)
+                self._counters["misses"] += 1
+                return False, None
+            if now - entry[2] > ResponseCache.TOUCH_INTERVAL:
+                entry[2] = now
+                with self._connection:
+                    self._connection.execute(
+                        "UPDATE responses SET accessed = ? WHERE title = ?", (now, key))
+            self._remember(key, entry)
+            if entry[0] is None:
+                self._counters["negative_hits"] += 1
+                return True, None
+            self._counters["hits"] += 1
+            return True, json.loads(entry[0])
+
+    def put(self, title, response):
+        """Stores response for title, None stores a negative entry."""
+        key = self.normalize(title)
+        now = time.time()
+        payload = None if response is None else json.dumps(response)
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                    (key, payload, now, now))
+                self._counters["stores"] += 1
+                self._evict()
+            self._remember(key, [payload, now, now])
+
+    def _evict(self):
+        """Deletes the least recently used entries above max_entries."""
+        count = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        extra = count - self._max_entries
+        if extra <= 0:
+            return
+        rows = self._connection.execute(
+            "SELECT title FROM responses ORDER BY accessed LIMIT ?", (extra,)).fetchall()
+        self._connection.executemany("DELETE FROM responses WHERE title = ?", rows)
+        for (title,) in rows:
+            self._memory.pop(title, None)
+        self._counters["evictions"] += len(rows)
+
+    def clear(self):
+        """Removes every entry."""
+        with self._lock:
+            with self._connection:
+                self._connection.execute("DELETE FROM responses")
+            self._memory.clear()
+
+    def stats(self):
+        """Returns the hit/miss counters and the number of stored entries."""
+        with self._lock:
+            entries = self._connection.execute(
+                "SELECT COUNT(*) FROM responses").fetchone()[0]
+            return dict(self._counters, entries=entries)
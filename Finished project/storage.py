@@ -1,9 +1,20 @@
 """Methods for json data to the database."""
 
+import io
 import os
 import csv
 import json
+import sqlite3
+import threading
+from itertools import islice
+from contextlib import contextmanager
 from istorage import IStorage
+from movie_record import Movie
+import metrics
+try:
+    import fcntl
+except ImportError:  # not available on Windows, locks are skipped there
+    fcntl = None
 
 
 class StorageError(Exception):
@@ -13,50 +24,349 @@ class StorageError(Exception):
         super().__init__(message)
 
 
-class StorageJson(IStorage):
-    """This class is used to store movies in a json file."""
+class MovieExistsError(StorageError):
+    """MovieExistsError is raised when the movie is already stored."""
+
+
+class MovieNotFoundError(StorageError):
+    """MovieNotFoundError is raised when the movie isn't stored."""
+
+
+def file_signature(file_path):
+    """Returns (mtime, size, inode) of the file or None if it doesn't exist.
+    Any write made by another process changes at least one of them."""
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+def atomic_write(file_path, write, mode="w", **open_arguments):
+    """Writes file_path through a temporary file in the same folder:
+    write(file) fills it, it is flushed to disk and renamed over
+    file_path, so readers and crashes see the old or the new file."""
+    import tempfile
+    folder = os.path.dirname(file_path) or "."
+    descriptor, temp_path = tempfile.mkstemp(
+        prefix=os.path.basename(file_path) + ".", suffix=".tmp", dir=folder)
+    try:
+        with os.fdopen(descriptor, mode, **open_arguments) as temp_file:
+            write(temp_file)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class FileLock:
+    """Advisory fcntl lock on <file>.lock, shared for reads and exclusive
+    for read-modify-write. The data files are replaced on write, so the
+    lock lives in its own file. Each thread uses its own descriptor, so
+    threads exclude each other like processes do, and a thread can nest
+    locks (a shared holder asking exclusive is upgraded)."""
 
     def __init__(self, file_path):
+        self._path = file_path + ".lock"
+        self._local = threading.local()
+        self._descriptors = []
+        self._descriptors_lock = threading.Lock()
+
+    @contextmanager
+    def _hold(self, mode):
+        """Holds the lock in mode for the block."""
+        if fcntl is None:
+            yield
+            return
+        if not hasattr(self._local, "descriptor"):
+            self._local.descriptor = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._local.modes = []
+            with self._descriptors_lock:
+                self._descriptors.append(self._local.descriptor)
+        modes = self._local.modes
+        held = modes[-1] if modes else None
+        effective = mode if held is None else max(mode, held)
+        if effective != held:
+            fcntl.flock(self._local.descriptor, effective)
+        modes.append(effective)
+        try:
+            yield
+        finally:
+            modes.pop()
+            if not modes:
+                fcntl.flock(self._local.descriptor, fcntl.LOCK_UN)
+            elif modes[-1] != effective:
+                fcntl.flock(self._local.descriptor, modes[-1])
+
+    def shared(self):
+        """Lock for reading."""
+        return self._hold(fcntl.LOCK_SH if fcntl else 1)
+
+    def exclusive(self):
+        """Lock for read-modify-write."""
+        return self._hold(fcntl.LOCK_EX if fcntl else 2)
+
+    def close(self):
+        """Closes the descriptors of every thread, a later use opens new ones."""
+        with self._descriptors_lock:
+            self._local = threading.local()
+            for descriptor in self._descriptors:
+                os.close(descriptor)
+            self._descriptors = []
+
+
+# characters read per step when a json file is parsed incrementally
+STREAM_CHUNK = 64 * 1024
+
+
+def _count_bytes(storage, direction, amount=None, path=None):
+    """Counts bytes read or written by a backend when metrics are on,
+    amount defaults to the size of path."""
+    if metrics.REGISTRY.enabled:
+        if amount is None:
+            amount = os.path.getsize(path)
+        metrics.REGISTRY.inc(f"movie_storage_bytes_{direction}_total", amount,
+                             backend=type(storage).__name__)
+
+
+class StorageJson(IStorage):
+    """This class is used to store movies in a json file.
+    With cached=True the parsed dictionary is kept in memory and the file
+    is parsed again only when its signature changes (outside writers).
+    The file is replaced atomically on write, reads take a shared and
+    mutations an exclusive FileLock."""
+
+    def __init__(self, file_path, cached=False):
         """Recive file path with name without extension"""
         file_path = file_path + ".json"
+        self._file_lock = FileLock(file_path)
         if not os.path.exists(file_path):
-            with open(file_path, "w", encoding="utf-8") as json_file:
-                json.dump({}, json_file, indent=4)
+            with self._file_lock.exclusive():
+                if not os.path.exists(file_path):
+                    atomic_write(file_path, lambda json_file: json.dump({}, json_file, indent=4),
+                                 encoding="utf-8")
         self._file_path = file_path
+        self._cached = cached
+        self._cache = None
+        self._cache_signature = None
+        self._deferred = False
+        self._dirty = False
 
-    def _read_file(self):
-        """Reads the data from the file and returns it as a dictionary."""
+    def signature(self):
+        """Signature of the files backing this storage."""
+        return file_signature(self._file_path)
+
+    def sidecar_path(self, suffix):
+        """Derived files sit next to the json file."""
+        return self._file_path + suffix
+
+    def _write_lock(self):
+        """Other processes wait while a mutation reads and writes the file."""
+        return self._file_lock.exclusive()
+
+    def _read_lock(self):
+        """Readers share the file lock."""
+        return self._file_lock.shared()
+
+    def close(self):
+        """Closes the lock file descriptors."""
+        self._file_lock.close()
+
+    def _load(self):
+        """Parses the json file and returns it as a dictionary."""
         try:
             with open(self._file_path, "r", encoding="utf-8") as json_file:
                 data = json.load(json_file)
+            _count_bytes(self, "read", path=self._file_path)
             return data
         except json.decoder.JSONDecodeError as jdecoder:
             raise StorageError(
                 f"Error decoding json file {self._file_path}:\n\t--> {jdecoder}") from jdecoder
 
+    def _read_file(self):
+        """Reads the data from the file and returns it as a dictionary.
+        In cached mode the returned dictionary is the cache itself."""
+        if self._deferred and self._dirty:
+            return self._cache
+        with self._file_lock.shared():
+            if not self._cached:
+                return self._load()
+            signature = self.signature()
+            if self._cache is not None and signature == self._cache_signature:
+                return self._cache
+            try:
+                data = self._load()
+            except StorageError:
+                self._invalidate_cache()
+                raise
+        self._cache = data
+        self._cache_signature = signature
+        return data
+
     def _write_file(self, data):
-        """Writes the data to the file."""
-        with open(self._file_path, "w", encoding="utf-8") as json_file:
-            json.dump(data, json_file, indent=4)
+        """Writes the data to the file, or only to the cache while writes
+        are deferred."""
+        if self._deferred:
+            self._cache = data
+            self._dirty = True
+            return
+        with self._file_lock.exclusive():
+            try:
+                atomic_write(self._file_path,
+                             lambda json_file: json.dump(data, json_file, indent=4),
+                             encoding="utf-8")
+            except Exception:
+                self._invalidate_cache()
+                raise
+            _count_bytes(self, "written", path=self._file_path)
+            if self._cached:
+                self._cache = data
+                self._cache_signature = self.signature()
+
+    def _invalidate_cache(self):
+        """Drops the in memory copy, next read parses the file again."""
+        self._cache = None
+        self._cache_signature = None
+
+    def _flush(self):
+        """Writes what deferred writes kept in memory."""
+        self._write_file(self._cache)
+
+    @contextmanager
+    def deferred_writes(self):
+        """Keeps every change of the block in memory and writes the file
+        once at the end. Changes are dropped when the block raises. The
+        exclusive lock is held for the whole block."""
+        if self._deferred:
+            yield self
+            return
+        cached = self._cached
+        with self._file_lock.exclusive():
+            self._cached = True
+            self._deferred = True
+            self._dirty = False
+            try:
+                yield self
+            except BaseException:
+                if self._dirty:
+                    self._invalidate_cache()
+                    self._invalidate_views()
+                raise
+            else:
+                self._deferred = False
+                if self._dirty:
+                    before = self._cache_signature
+                    self._flush()
+                    self._signature_moved(before)
+            finally:
+                self._deferred = False
+                self._dirty = False
+                self._cached = cached
 
     def list_movies(self):
         """Returns a dictionary of dictionaries that"""
         data = self._read_file()
         return data
 
+    def _cache_current(self):
+        """Checks whether the in memory copy matches the file."""
+        if self._deferred and self._dirty:
+            return True
+        return self._cached and self._cache is not None and \
+            self.signature() == self._cache_signature
+
+    def iter_movies(self):
+        """Yields (title, info) pairs. A current cache is iterated, otherwise
+        the file is parsed one movie at a time (see _parse_movies)."""
+        if self._cache_current():
+            yield from list(self._cache.items())
+            return
+        with self._file_lock.shared():
+            # a replaced file stays readable through this handle
+            json_file = open(self._file_path, "r", encoding="utf-8")
+        with json_file:
+            yield from self._parse_movies(json_file)
+
+    def _parse_movies(self, json_file, chunk_size=STREAM_CHUNK):
+        """Parses {title: info, ...} incrementally: only the movie being
+        decoded and one chunk of text are held in memory."""
+        decoder = json.JSONDecoder()
+        buffer, position, at_end = "", 0, False
+
+        def fill():
+            nonlocal buffer, position, at_end
+            chunk = json_file.read(chunk_size)
+            at_end = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            return not at_end
+
+        def skip_space():
+            nonlocal position
+            while True:
+                position = json.decoder.WHITESPACE.match(buffer, position).end()
+                if position < len(buffer) or not fill():
+                    return buffer[position:position + 1]
+
+        def decode():
+            nonlocal position
+            skip_space()
+            while True:
+                try:
+                    value, position = decoder.raw_decode(buffer, position)
+                    return value
+                except json.decoder.JSONDecodeError as jdecoder:
+                    if not fill():
+                        raise StorageError(f"Error decoding json file {self._file_path}:"
+                                           f"\n\t--> {jdecoder}") from jdecoder
+
+        def expect(characters):
+            nonlocal position
+            character = skip_space()
+            if not character or character not in characters:
+                raise StorageError(f"Error decoding json file {self._file_path}:\n\t--> "
+                                   f"expected {characters!r}, found {character!r}")
+            position += 1
+            return character
+
+        expect("{")
+        if skip_space() == "}":
+            return
+        while True:
+            title = decode()
+            expect(":")
+            yield title, decode()
+            if expect(",}") == "}":
+                return
+
     def add_movie(self, title, year, rating, poster) -> None:
         """Adds a movie to the movies database."""
         data = self._read_file()
         if title in data:
-            raise StorageError("Movie already exists in json file")
+            raise MovieExistsError("Movie already exists in json file")
         data[title] = {"Year": year, "imdbRating": rating, "Poster": poster}
         self._write_file(data)
 
+    def add_movies(self, movies):
+        """Adds a batch of movies with a single write, returns skipped titles."""
+        data = self._read_file()
+        skipped = []
+        for title, year, rating, poster in movies:
+            if title in data:
+                skipped.append(title)
+                continue
+            data[title] = {"Year": year, "imdbRating": rating, "Poster": poster}
+        self._write_file(data)
+        return skipped
+
     def delete_movie(self, title):
         """Deletes a movie from the movies database."""
         data = self._read_file()
         if title not in data:
-            raise StorageError("Movie doesn't exist in json file")
+            raise MovieNotFoundError("Movie doesn't exist in json file")
         del data[title]
         self._write_file(data)
 
@@ -67,45 +377,242 @@ class StorageJson(IStorage):
             data[title]["imdbRating"] = float(rating)
             self._write_file(data)
         else:
-            raise StorageError("Movie doesn't exist in json file")
+            raise MovieNotFoundError("Movie doesn't exist in json file")
 
     def __str__(self):
-        movies = self._read_file()
         movies_map = map(lambda item:
                          f"{item[0]}. {item[1][0]}, Year: {item[1][1]['Year']}, imdbRating: {item[1][1]['imdbRating']}",
-                         enumerate(movies.items(), start=1))
+                         enumerate(self.iter_movies(), start=1))
         return "\n".join(movies_map)
 
 
+class StorageJsonJournal(StorageJson):
+    """Json storage that appends every mutation to a sidecar log
+    (<file>.json.log, one json record per line) instead of rewriting the
+    whole file. The snapshot and the log are merged on load and the
+    snapshot is rewritten (compacted) once the log grows past
+    compact_entries records or compact_ratio times the snapshot size."""
+
+    MIN_COMPACT_BYTES = 64 * 1024
+
+    def __init__(self, file_path, compact_entries=1000, compact_ratio=0.5):
+        """Recive file path with name without extension"""
+        super().__init__(file_path, cached=True)
+        self._log_path = self._file_path + ".log"
+        self._log_entries = 0
+        self._pending = []
+        self._compact_entries = compact_entries
+        self._compact_ratio = compact_ratio
+
+    @staticmethod
+    def _apply(data, record):
+        """Applies one log record to data. Replaying a record twice gives
+        the same result, so a crash during compaction is harmless."""
+        operation = record["op"]
+        if operation == "add":
+            data[record["title"]] = record["movie"]
+        elif operation == "delete":
+            data.pop(record["title"], None)
+        elif operation == "update" and record["title"] in data:
+            data[record["title"]]["imdbRating"] = record["rating"]
+
+    def signature(self):
+        """Signature of both the snapshot and the log file."""
+        return (file_signature(self._file_path), file_signature(self._log_path))
+
+    def _load(self):
+        """Reads the snapshot and replays the log on top of it."""
+        data = super()._load()
+        self._log_entries = 0
+        if not os.path.exists(self._log_path):
+            return data
+        with open(self._log_path, "r", encoding="utf-8") as log_file:
+            for line in log_file:
+                try:
+                    record = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    # torn last line of an interrupted append
+                    continue
+                self._apply(data, record)
+                self._log_entries += 1
+        _count_bytes(self, "read", path=self._log_path)
+        return data
+
+    def _append_log(self, data, *records):
+        """Appends records to the log, applies them to data and compacts
+        the log when it passed the thresholds. While writes are deferred
+        the records are only kept in memory."""
+        if self._deferred:
+            self._pending.extend(records)
+            self._dirty = True
+        else:
+            self._write_log(records)
+        for record in records:
+            self._apply(data, record)
+        if not self._deferred and self._needs_compaction():
+            self.compact()
+
+    def _write_log(self, records):
+        """Writes records at the end of the log in a single write."""
+        try:
+            lines = "".join(json.dumps(record) + "\n" for record in records)
+            with self._file_lock.exclusive(), \
+                    open(self._log_path, "a", encoding="utf-8") as log_file:
+                log_file.write(lines)
+        except OSError:
+            self._invalidate_cache()
+            raise
+        _count_bytes(self, "written", len(lines.encode("utf-8")))
+        self._log_entries += len(records)
+        self._cache_signature = self.signature()
+
+    def _needs_compaction(self):
+        """Checks log size against the configured thresholds."""
+        if self._log_entries >= self._compact_entries:
+            return True
+        log_size = os.path.getsize(self._log_path)
+        snapshot_size = os.path.getsize(self._file_path)
+        return log_size > max(self.MIN_COMPACT_BYTES,
+                              self._compact_ratio * snapshot_size)
+
+    def _write_file(self, data):
+        """Writes the snapshot and empties the log."""
+        with self._file_lock.exclusive():
+            super()._write_file(data)
+            if self._deferred:
+                return
+            if os.path.exists(self._log_path):
+                os.remove(self._log_path)
+            self._log_entries = 0
+            self._cache_signature = self.signature()
+
+    def _flush(self):
+        """Appends the records kept while writes were deferred."""
+        records, self._pending = self._pending, []
+        if records:
+            self._write_log(records)
+            if self._needs_compaction():
+                self.compact()
+
+    def _invalidate_cache(self):
+        """Drops the in memory copy and the records not written yet."""
+        super()._invalidate_cache()
+        self._pending = []
+
+    def iter_movies(self):
+        """The log can touch any movie, so the merged data is iterated."""
+        yield from list(self._read_file().items())
+
+    def compact(self):
+        """Rewrites the snapshot with the merged data and drops the log."""
+        with self._file_lock.exclusive():
+            self._write_file(self._read_file())
+
+    def add_movie(self, title, year, rating, poster) -> None:
+        """Adds a movie to the movies database."""
+        data = self._read_file()
+        if title in data:
+            raise MovieExistsError("Movie already exists in json file")
+        self._append_log(data, {"op": "add", "title": title, "movie": {
+            "Year": year, "imdbRating": rating, "Poster": poster}})
+
+    def add_movies(self, movies):
+        """Appends a batch of add records in one write, returns skipped titles."""
+        data = self._read_file()
+        skipped, records, seen = [], [], set()
+        for title, year, rating, poster in movies:
+            if title in data or title in seen:
+                skipped.append(title)
+                continue
+            seen.add(title)
+            records.append({"op": "add", "title": title, "movie": {
+                "Year": year, "imdbRating": rating, "Poster": poster}})
+        if records:
+            self._append_log(data, *records)
+        return skipped
+
+    def delete_movie(self, title):
+        """Deletes a movie from the movies database."""
+        data = self._read_file()
+        if title not in data:
+            raise MovieNotFoundError("Movie doesn't exist in json file")
+        self._append_log(data, {"op": "delete", "title": title})
+
+    def update_movie(self, title, rating):
+        """Updates a movie's rating in the log."""
+        data = self._read_file()
+        if title not in data:
+            raise MovieNotFoundError("Movie doesn't exist in json file")
+        self._append_log(data, {"op": "update", "title": title,
+                                "rating": float(rating)})
+
+
 class StorageCsv(IStorage):
-    """This class is used to store movies in a csv file."""
+    """This class is used to store movies in a csv file.
+    With indexed=True a title -> byte offset index is kept next to the csv
+    (<file>.csv.idx). Lookups and duplicate checks use the index, deletes
+    blank the row in place (tombstone) and updates append the new row and
+    tombstone the old one. vacuum() drops the dead rows.
+    Rewrites replace the file atomically, reads take a shared and
+    mutations an exclusive FileLock."""
 
-    def __init__(self, file_path):
+    FIELDNAMES = ["Title", "Year", "imdbRating", "Poster"]
+    MIN_VACUUM_ROWS = 64
+    STREAM_ROWS = 512
+
+    def __init__(self, file_path, indexed=True, vacuum_ratio=0.3):
         """Recive file path with name without extension"""
         file_path = file_path + ".csv"
         self._file_path = file_path
+        self._index_path = file_path + ".idx"
+        self._indexed = indexed
+        self._vacuum_ratio = vacuum_ratio
+        self._offsets = None
+        self._dead = 0
+        self._index_log_entries = 0
+        self._index_signature = None
+        self._file_lock = FileLock(file_path)
         if not os.path.exists(file_path):
-            self._initialize_csv()
+            with self._file_lock.exclusive():
+                if not os.path.exists(file_path):
+                    self._initialize_csv()
 
     def _initialize_csv(self):
         """Initializes the CSV file with a header row"""
-        with open(self._file_path, "w", newline="", encoding="utf-8") as csv_file:
-            writer = csv.DictWriter(csv_file, fieldnames=[
-                                    "Title", "Year", "imdbRating", "Poster"])
-            writer.writeheader()
+        atomic_write(self._file_path,
+                     lambda csv_file: csv.DictWriter(
+                         csv_file, fieldnames=StorageCsv.FIELDNAMES).writeheader(),
+                     newline="", encoding="utf-8")
+
+    def _write_lock(self):
+        """Other processes wait while a mutation reads and writes the file."""
+        return self._file_lock.exclusive()
+
+    def _read_lock(self):
+        """Readers share the file lock."""
+        return self._file_lock.shared()
+
+    def close(self):
+        """Closes the lock file descriptors."""
+        self._file_lock.close()
 
     def _read_file(self):
         """Method of csv.DictReader returns a list of dictionaries.
         Each dictionary is a row in the csv file. This function iterates
         list and all list items are  dictionaries. Assigns the key of the
-        dictionary to the title and the value to the dictionary."""
+        dictionary to the title and the value to the dictionary.
+        Tombstoned (blank) rows are skipped."""
         try:
-            with open(self._file_path, "r", newline="", encoding="utf-8") as csv_file:
+            with self._file_lock.shared(), \
+                    open(self._file_path, "r", newline="", encoding="utf-8") as csv_file:
                 reader = csv.DictReader(csv_file)
                 data = {}
                 for row in reader:
+                    if not row["Title"].strip():
+                        continue
                     data[row["Title"]] = {
                         "Year": row["Year"], "imdbRating": row["imdbRating"], "Poster": row["Poster"]}
+            _count_bytes(self, "read", path=self._file_path)
             return data
         except csv.Error as csverror:
             raise StorageError(
@@ -113,52 +620,513 @@ class StorageCsv(IStorage):
 
     def _write_file(self, data: dict):
         """Writes the data as the form of a dictionary to the file."""
-        with open(self._file_path, mode="w", newline="", encoding="utf-8") as csv_file:
-            fieldnames = ["Title", "Year", "imdbRating", "Poster"]
-            writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+        def write(csv_file):
+            writer = csv.DictWriter(csv_file, fieldnames=StorageCsv.FIELDNAMES)
             writer.writeheader()
             for title, info in data.items():
                 writer.writerow({"Title": title, "Year": info["Year"],
                                 "imdbRating": info["imdbRating"], "Poster": info["Poster"]})
+        with self._file_lock.exclusive():
+            atomic_write(self._file_path, write, newline="", encoding="utf-8")
+            _count_bytes(self, "written", path=self._file_path)
+            if self._indexed:
+                self._build_index()
 
     def _append_file(self, data):
         """Appends the data to the file."""
         with open(self._file_path, mode="a", newline="", encoding="utf-8") as csv_file:
-            fieldnames = ["Title", "Year", "imdbRating", "Poster"]
-            writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+            writer = csv.DictWriter(csv_file, fieldnames=StorageCsv.FIELDNAMES)
             writer.writerow({"Title": data["Title"], "Year": data["Year"],
                              "imdbRating": data["imdbRating"], "Poster": data["Poster"]})
 
+    @staticmethod
+    def _encode_row(title, info):
+        """Returns the csv row of a movie as bytes."""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow([title, info["Year"], info["imdbRating"], info["Poster"]])
+        return buffer.getvalue().encode("utf-8")
+
+    @staticmethod
+    def _read_record(csv_file):
+        """Reads one csv record from the current position of a binary file.
+        A quoted field can hold new lines, so lines are joined until the
+        quotes are balanced."""
+        record = b""
+        while True:
+            line = csv_file.readline()
+            record += line
+            if not line or record.count(b'"') % 2 == 0:
+                return record
+
+    @staticmethod
+    def _parse_record(record):
+        """Parses the bytes of one csv record to a list of fields."""
+        try:
+            rows = list(csv.reader(io.StringIO(record.decode("utf-8"), newline="")))
+        except csv.Error as csverror:
+            raise StorageError(f"Error reading csv record:\n\t--> {csverror}") from csverror
+        return rows[0] if rows else []
+
+    def _scan_records(self):
+        """Yields (offset, fields) of every record after the header."""
+        with open(self._file_path, "rb") as csv_file:
+            self._read_record(csv_file)
+            while True:
+                offset = csv_file.tell()
+                record = self._read_record(csv_file)
+                if not record:
+                    return
+                yield offset, self._parse_record(record)
+
+    def signature(self):
+        """Signature of the csv file."""
+        return file_signature(self._file_path)
+
+    def sidecar_path(self, suffix):
+        """Derived files sit next to the csv file."""
+        return self._file_path + suffix
+
+    def _build_index(self):
+        """Scans the csv once and writes a fresh index file."""
+        offsets = {}
+        dead = 0
+        with self._file_lock.exclusive():
+            for offset, fields in self._scan_records():
+                if not fields or not fields[0].strip():
+                    dead += 1
+                    continue
+                if fields[0] in offsets:
+                    dead += 1
+                offsets[fields[0]] = offset
+            self._offsets = offsets
+            self._dead = dead
+            self._save_index()
+
+    def _save_index(self):
+        """Writes the whole index file: a header line and one line per title."""
+        self._index_signature = file_signature(self._file_path)
+
+        def write(index_file):
+            index_file.write(json.dumps({"dead": self._dead}) + "\n")
+            for title, offset in self._offsets.items():
+                index_file.write(json.dumps([title, offset]) + "\n")
+            index_file.write(json.dumps({"signature": self._index_signature}) + "\n")
+        atomic_write(self._index_path, write, encoding="utf-8")
+        self._index_log_entries = 0
+
+    def _log_index(self, changes):
+        """Appends (title, offset or None) changes to the index file
+        followed by the new csv signature. The file is rewritten once
+        the appended lines outnumber the live titles."""
+        self._index_signature = file_signature(self._file_path)
+        self._index_log_entries += len(changes)
+        if self._index_log_entries > len(self._offsets) + StorageCsv.MIN_VACUUM_ROWS:
+            self._save_index()
+            return
+        with open(self._index_path, "a", encoding="utf-8") as index_file:
+            for title, offset in changes:
+                index_file.write(json.dumps([title, offset]) + "\n")
+            index_file.write(json.dumps({"signature": self._index_signature,
+                                         "dead": self._dead}) + "\n")
+
+    def _load_index(self):
+        """Makes sure the in memory index matches the csv file. Uses the
+        index file when its last signature matches, otherwise rebuilds it."""
+        with self._file_lock.shared():
+            return self._read_index()
+
+    def _read_index(self):
+        """_load_index under the lock."""
+        signature = file_signature(self._file_path)
+        if self._offsets is not None and signature == self._index_signature:
+            return self._offsets
+        offsets, dead, saved_signature, entries = {}, 0, None, 0
+        try:
+            with open(self._index_path, "r", encoding="utf-8") as index_file:
+                for line in index_file:
+                    entry = json.loads(line)
+                    if isinstance(entry, dict):
+                        dead = entry.get("dead", dead)
+                        saved_signature = entry.get("signature", saved_signature)
+                    elif entry[1] is None:
+                        offsets.pop(entry[0], None)
+                    else:
+                        offsets[entry[0]] = entry[1]
+                    entries += 1
+        except (OSError, ValueError, IndexError):
+            saved_signature = None
+        if saved_signature is not None and list(signature) == saved_signature:
+            self._offsets = offsets
+            self._dead = dead
+            self._index_signature = signature
+            self._index_log_entries = max(0, entries - len(offsets))
+        else:
+            self._build_index()
+        return self._offsets
+
+    def _read_at(self, offset):
+        """Returns the raw record stored at offset."""
+        with open(self._file_path, "rb") as csv_file:
+            csv_file.seek(offset)
+            return self._read_record(csv_file)
+
+    def _append_row(self, title, info):
+        """Appends a row and returns its offset."""
+        if os.path.getsize(self._file_path) == 0:
+            self._initialize_csv()
+        row = self._encode_row(title, info)
+        with open(self._file_path, "ab") as csv_file:
+            offset = csv_file.seek(0, os.SEEK_END)
+            csv_file.write(row)
+        _count_bytes(self, "written", len(row))
+        return offset
+
+    def _tombstone(self, offset):
+        """Blanks the record at offset in place, keeping its line ending."""
+        record = self._read_at(offset)
+        body = record.rstrip(b"\r\n")
+        with open(self._file_path, "r+b") as csv_file:
+            csv_file.seek(offset)
+            csv_file.write(b" " * len(body))
+        _count_bytes(self, "written", len(body))
+        self._dead += 1
+
+    def _maybe_vacuum(self):
+        """Vacuums when dead rows passed vacuum_ratio of all rows."""
+        total = len(self._offsets) + self._dead
+        if self._dead >= StorageCsv.MIN_VACUUM_ROWS and self._dead > self._vacuum_ratio * total:
+            self.vacuum()
+
+    def vacuum(self):
+        """Rewrites the file without the dead rows."""
+        with self._file_lock.exclusive():
+            self._write_file(self._read_file())
+        if not self._indexed:
+            self._offsets = None
+
+    def get_movie(self, title):
+        """Returns the movie info of title or None."""
+        if not self._indexed:
+            return self._read_file().get(title)
+        with self._file_lock.shared():
+            offset = self._load_index().get(title)
+            if offset is None:
+                return None
+            fields = self._parse_record(self._read_at(offset))
+        return {"Year": fields[1], "imdbRating": fields[2], "Poster": fields[3]}
+
     def list_movies(self):
         """list_movies is a method that returns a dictionary."""
         return self._read_file()
 
+    def iter_movies(self):
+        """Yields (title, info) pairs while reading the csv. Rows are read
+        STREAM_ROWS at a time under the shared lock, so a tombstone is
+        never seen half written."""
+        with self._file_lock.shared():
+            csv_file = open(self._file_path, "r", newline="", encoding="utf-8")
+        with csv_file:
+            reader = csv.reader(csv_file)
+            try:
+                with self._file_lock.shared():
+                    next(reader, None)
+                while True:
+                    with self._file_lock.shared():
+                        rows = list(islice(reader, StorageCsv.STREAM_ROWS))
+                    for row in rows:
+                        if row and row[0].strip():
+                            row = (row + [None, None, None])[:4]
+                            yield row[0], {"Year": row[1], "imdbRating": row[2], "Poster": row[3]}
+                    if len(rows) < StorageCsv.STREAM_ROWS:
+                        return
+            except csv.Error as csverror:
+                raise StorageError(
+                    f"Error reading csv file {self._file_path}:\n\t--> {csverror}") from csverror
+
+    def list_records(self):
+        """Builds the records straight from the csv rows."""
+        try:
+            with self._file_lock.shared(), \
+                    open(self._file_path, "r", newline="", encoding="utf-8") as csv_file:
+                reader = csv.reader(csv_file)
+                next(reader, None)
+                records = {}
+                for row in reader:
+                    if not row or not row[0].strip():
+                        continue
+                    records[row[0]] = Movie(*(row + [None, None, None])[:4])
+            _count_bytes(self, "read", path=self._file_path)
+            return list(records.values())
+        except csv.Error as csverror:
+            raise StorageError(
+                f"Error reading csv file {self._file_path}:\n\t--> {csverror}") from csverror
+
     def add_movie(self, title, year, rating, poster):
-        """If there is not duplication checks file size
-        Uses _write_file for empty files otherwise _append_file method."""
-        new_data = {}
-        if title in self._read_file():
-            raise StorageError("Movie already exists in csv file")
-        new_data = {"Title": title, "Year": year,
-                    "imdbRating": rating, "Poster": poster}
+        """Adds a movie to the end of the file, the index is used for
+        the duplication check."""
+        if not self._indexed:
+            if title in self._read_file():
+                raise MovieExistsError("Movie already exists in csv file")
+            if os.path.getsize(self._file_path) == 0:
+                self._initialize_csv()
+            self._append_file({"Title": title, "Year": year,
+                               "imdbRating": rating, "Poster": poster})
+            return
+        offsets = self._load_index()
+        if title in offsets:
+            raise MovieExistsError("Movie already exists in csv file")
+        offsets[title] = self._append_row(
+            title, {"Year": year, "imdbRating": rating, "Poster": poster})
+        self._log_index([(title, offsets[title])])
+
+    def add_movies(self, movies):
+        """Appends a batch of movies with one open of the file,
+        returns skipped titles."""
+        if not self._indexed:
+            return super().add_movies(movies)
+        offsets = self._load_index()
         if os.path.getsize(self._file_path) == 0:
-            self._write_file(new_data)
-        else:
-            self._append_file(new_data)
+            self._initialize_csv()
+        skipped, changes = [], []
+        with open(self._file_path, "ab") as csv_file:
+            offset = csv_file.seek(0, os.SEEK_END)
+            for title, year, rating, poster in movies:
+                if title in offsets:
+                    skipped.append(title)
+                    continue
+                row = self._encode_row(
+                    title, {"Year": year, "imdbRating": rating, "Poster": poster})
+                csv_file.write(row)
+                offsets[title] = offset
+                changes.append((title, offset))
+                offset += len(row)
+        _count_bytes(self, "written", offset - changes[0][1] if changes else 0)
+        if changes:
+            self._log_index(changes)
+        return skipped
 
     def delete_movie(self, title):
-        """delete_movie is a method that returns a dictionary."""
-        movies = self._read_file()
-        if title not in movies:
-            raise StorageError("Movie not found in csv file")
-        del movies[title]
-        self._write_file(movies)
+        """Tombstones the row of title."""
+        if not self._indexed:
+            movies = self._read_file()
+            if title not in movies:
+                raise MovieNotFoundError("Movie not found in csv file")
+            del movies[title]
+            self._write_file(movies)
+            return
+        offsets = self._load_index()
+        if title not in offsets:
+            raise MovieNotFoundError("Movie not found in csv file")
+        self._tombstone(offsets.pop(title))
+        self._log_index([(title, None)])
+        self._maybe_vacuum()
 
     def update_movie(self, title, rating):
-        """update_movie is a method that returns a dictionary."""
-        movies = self._read_file()
-        if title not in movies:
-            raise StorageError("Movie not found in csv file")
-        movie = movies[title]
+        """Appends the updated row and tombstones the old one."""
+        if not self._indexed:
+            movies = self._read_file()
+            if title not in movies:
+                raise MovieNotFoundError("Movie not found in csv file")
+            movies[title]["imdbRating"] = rating
+            self._write_file(movies)
+            return
+        movie = self.get_movie(title)
+        if movie is None:
+            raise MovieNotFoundError("Movie not found in csv file")
         movie["imdbRating"] = rating
-        self._write_file(movies)
+        old_offset = self._offsets[title]
+        self._offsets[title] = self._append_row(title, movie)
+        self._tombstone(old_offset)
+        self._log_index([(title, self._offsets[title])])
+        self._maybe_vacuum()
+
+
+class StorageSqlite(IStorage):
+    """This class is used to store movies in a sqlite database (WAL mode).
+    Title is the primary key, year and imdbRating are indexed so sorting
+    and statistics run inside sqlite instead of over a python dict."""
+
+    STREAM_ROWS = 512
+
+    def __init__(self, file_path):
+        """Recive file path with name without extension"""
+        file_path = file_path + ".sqlite3"
+        self._file_path = file_path
+        self._lock = threading.Lock()
+        self._deferred = False
+        try:
+            self._connection = sqlite3.connect(file_path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            with self._connection:
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS movies ("
+                    "title TEXT PRIMARY KEY, year TEXT, imdbRating REAL, poster TEXT)")
+                self._connection.execute(
+                    "CREATE INDEX IF NOT EXISTS movies_year ON movies(year)")
+                self._connection.execute(
+                    "CREATE INDEX IF NOT EXISTS movies_rating ON movies(imdbRating)")
+        except sqlite3.Error as sql_error:
+            raise StorageError(
+                f"Error opening sqlite file {file_path}:\n\t--> {sql_error}") from sql_error
+
+    @contextmanager
+    def _transaction(self):
+        """Holds the connection for one change, commits it at the end
+        unless writes are deferred (see deferred_writes)."""
+        with self._lock:
+            try:
+                yield self._connection
+                if not self._deferred:
+                    self._connection.commit()
+            except sqlite3.Error as sql_error:
+                if not self._deferred:
+                    self._connection.rollback()
+                raise StorageError(
+                    f"Error querying sqlite file {self._file_path}:\n\t--> {sql_error}") from sql_error
+            except Exception:
+                if not self._deferred:
+                    self._connection.rollback()
+                raise
+
+    def _execute(self, query, parameters=()):
+        """Runs a query and returns all rows."""
+        with self._transaction() as connection:
+            return connection.execute(query, parameters).fetchall()
+
+    @contextmanager
+    def deferred_writes(self):
+        """Runs every change of the block in one transaction."""
+        if self._deferred:
+            yield self
+            return
+        self._deferred = True
+        try:
+            yield self
+        except BaseException:
+            with self._lock:
+                self._connection.rollback()
+            self._invalidate_views()
+            raise
+        else:
+            with self._lock:
+                self._connection.commit()
+        finally:
+            self._deferred = False
+
+    @staticmethod
+    def _rating_value(rating):
+        """Ratings are stored as REAL, anything else (e.g. "N/A") as NULL
+        which sqlite orders before every number like an unrated movie."""
+        try:
+            return float(rating)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _to_movie(row):
+        """Converts a (year, rating, poster) row to a movie dictionary, a
+        NULL rating reads as "N/A" like the other backends return it."""
+        return {"Year": row[0], "imdbRating": "N/A" if row[1] is None else row[1],
+                "Poster": row[2]}
+
+    def list_movies(self):
+        """list_movies is a method that returns a dictionary."""
+        rows = self._execute("SELECT title, year, imdbRating, poster FROM movies")
+        return {row[0]: self._to_movie(row[1:]) for row in rows}
+
+    def iter_movies(self):
+        """Yields (title, info) pairs, STREAM_ROWS rows per query in rowid
+        order, so the connection is free between pages."""
+        last = 0
+        while True:
+            rows = self._execute(
+                "SELECT rowid, title, year, imdbRating, poster FROM movies "
+                "WHERE rowid > ? ORDER BY rowid LIMIT ?", (last, StorageSqlite.STREAM_ROWS))
+            for row in rows:
+                yield row[1], self._to_movie(row[2:])
+            if len(rows) < StorageSqlite.STREAM_ROWS:
+                return
+            last = rows[-1][0]
+
+    def list_records(self):
+        """Builds the records straight from the rows."""
+        with self._transaction() as connection:
+            return [Movie(*row) for row in connection.execute(
+                "SELECT title, year, imdbRating, poster FROM movies")]
+
+    def get_movie(self, title):
+        """Returns the movie info of title or None."""
+        rows = self._execute(
+            "SELECT year, imdbRating, poster FROM movies WHERE title = ?", (title,))
+        return self._to_movie(rows[0]) if rows else None
+
+    def add_movie(self, title, year, rating, poster):
+        """Adds a movie to the movies table."""
+        with self._transaction() as connection:
+            try:
+                connection.execute("INSERT INTO movies VALUES (?, ?, ?, ?)",
+                                   (title, year, self._rating_value(rating), poster))
+            except sqlite3.IntegrityError as error:
+                raise MovieExistsError("Movie already exists in sqlite file") from error
+
+    def add_movies(self, movies):
+        """Inserts a batch of movies in one transaction, returns skipped titles."""
+        skipped = []
+        with self._transaction() as connection:
+            for title, year, rating, poster in movies:
+                try:
+                    connection.execute(
+                        "INSERT INTO movies VALUES (?, ?, ?, ?)",
+                        (title, year, self._rating_value(rating), poster))
+                except sqlite3.IntegrityError:
+                    skipped.append(title)
+        return skipped
+
+    def delete_movie(self, title):
+        """Deletes a movie from the movies table."""
+        with self._transaction() as connection:
+            cursor = connection.execute("DELETE FROM movies WHERE title = ?", (title,))
+        if cursor.rowcount == 0:
+            raise MovieNotFoundError("Movie doesn't exist in sqlite file")
+
+    def update_movie(self, title, rating):
+        """Updates a movie's rating in the movies table."""
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE movies SET imdbRating = ? WHERE title = ?",
+                (self._rating_value(rating), title))
+        if cursor.rowcount == 0:
+            raise MovieNotFoundError("Movie doesn't exist in sqlite file")
+
+    def signature(self):
+        """sqlite's data_version, it changes when another connection commits."""
+        return self._execute("PRAGMA data_version")[0][0]
+
+    def sort_movies(self, descending=False, limit=None, offset=0):
+        """Returns (title, info) pairs ordered by imdbRating using its index."""
+        order = "DESC" if descending else "ASC"
+        rows = self._execute(
+            "SELECT title, year, imdbRating, poster FROM movies "
+            f"ORDER BY imdbRating {order}, title {order} LIMIT ? OFFSET ?",
+            (-1 if limit is None else limit, offset))
+        return [(row[0], self._to_movie(row[1:])) for row in rows]
+
+    def rating_stats(self):
+        """Returns count, max, min, average and median of imdbRating computed
+        by sqlite, the median is read through the rating index."""
+        count, max_rating, min_rating, average = self._execute(
+            "SELECT COUNT(imdbRating), MAX(imdbRating), MIN(imdbRating), "
+            "AVG(imdbRating) FROM movies")[0]
+        median = None
+        if count:
+            median = self._execute(
+                "SELECT imdbRating FROM movies WHERE imdbRating IS NOT NULL "
+                "ORDER BY imdbRating LIMIT 1 OFFSET ?", ((count - 1) // 2,))[0][0]
+        return {"count": count, "max": max_rating, "min": min_rating,
+                "average": average, "median": median}
+
+    def close(self):
+        """Closes the database connection."""
+        self._connection.close()
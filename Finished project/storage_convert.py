@@ -0,0 +1,243 @@
+"""Moves movie libraries between storage backends.
+
+    python storage_convert.py --from json --to sqlite
+    python storage_convert.py --from csv --to json --users raven,alice --workers 4
+
+Every user file of the source backend in STORAGE/ is streamed into the
+target backend through the IStorage interface (iter_movies/add_movies),
+users run in parallel in a process pool. After a user is converted the
+target is read back and its movie count and checksum are compared with
+the source. Progress is kept in a state file: finished users are skipped
+when the run is started again, an interrupted user is continued (titles
+already in the target are skipped by add_movies)."""
+import argparse
+import hashlib
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import islice
+from movie_record import Movie
+from storage import StorageError, atomic_write, json
+
+BATCH_SIZE = 1000
+# file name suffix of each backend in the user folder
+SUFFIXES = {"json": ".json", "journal": ".json", "csv": ".csv", "sqlite": ".sqlite3",
+            "mmap": ".mmap"}
+
+
+class ConvertError(Exception):
+    """ConvertError is a class for raising errors."""
+
+    def __init__(self, message: str) -> None:
+        super().__init__(message)
+
+
+class Checksum:
+    """Order independent checksum of a library: the sum of the sha256 of
+    every movie in a canonical form, so backends storing the same movies
+    differently (ratings as text, NULL for N/A) agree."""
+
+    def __init__(self):
+        self.count = 0
+        self._total = 0
+
+    def add(self, title, info):
+        """Adds one movie."""
+        record = Movie.from_info(title, info)
+        canonical = "\x1f".join((title, str(record.year), repr(record.rating),
+                                 record.poster or ""))
+        self._total += int.from_bytes(hashlib.sha256(canonical.encode("utf-8")).digest(), "big")
+        self.count += 1
+
+    def hexdigest(self):
+        """Returns the checksum as text."""
+        return format(self._total % (1 << 256), "064x")
+
+
+def _close(storage):
+    """Closes backends holding a connection."""
+    close = getattr(storage, "close", None)
+    if close is not None:
+        close()
+
+
+def convert(source, target, batch_size=BATCH_SIZE):
+    """Streams every movie of source into target in batches and returns
+    the (Checksum, skipped titles) of what was read. Only one batch is
+    held at a time; json targets keep their whole file in memory anyway
+    and are written once at the end (deferred_writes)."""
+    checksum = Checksum()
+    skipped = []
+    movies = source.iter_movies()
+    with target.deferred_writes():
+        while True:
+            batch = []
+            for title, info in islice(movies, batch_size):
+                checksum.add(title, info)
+                batch.append((title, info.get("Year"), info.get("imdbRating"), info.get("Poster")))
+            if not batch:
+                break
+            skipped.extend(target.add_movies(batch))
+    return checksum, skipped
+
+
+def checksum_of(storage):
+    """Streams storage and returns its Checksum."""
+    checksum = Checksum()
+    for title, info in storage.iter_movies():
+        checksum.add(title, info)
+    return checksum
+
+
+def convert_user(folder, user, source_backend, target_backend,
+                 resume=False, batch_size=BATCH_SIZE):
+    """Converts one user and validates the result. A non empty target is
+    only accepted when resuming an interrupted conversion. Runs in a
+    worker process, returns a json serializable result."""
+    from movie_user_app import get_user_storage
+    start = time.perf_counter()
+    path = os.path.join(folder, user)
+    result = {"user": user, "status": "failed"}
+    source = target = None
+    try:
+        source = get_user_storage(source_backend, path)
+        target = get_user_storage(target_backend, path)
+        movies = target.iter_movies()
+        empty = next(movies, None) is None
+        movies.close()
+        if not resume and not empty:
+            raise ConvertError(f"{target_backend} library of {user} is not empty")
+        expected, skipped = convert(source, target, batch_size)
+        _close(target)
+        target = get_user_storage(target_backend, path)
+        written = checksum_of(target)
+        result.update(count=expected.count, checksum=expected.hexdigest(),
+                      resumed_titles=len(skipped))
+        if written.count != expected.count:
+            raise ConvertError(f"{user}: {written.count} movies written, "
+                               f"{expected.count} expected")
+        if written.hexdigest() != expected.hexdigest():
+            raise ConvertError(f"{user}: checksum of the converted library differs")
+        result["status"] = "done"
+    except (ConvertError, StorageError, OSError) as error:
+        result["error"] = str(error)
+    finally:
+        for storage in (source, target):
+            if storage is not None:
+                _close(storage)
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def find_users(folder, source_backend):
+    """Returns the users having a library of source_backend in folder."""
+    suffix = SUFFIXES[source_backend]
+    if not os.path.isdir(folder):
+        return []
+    return sorted(name[:-len(suffix)] for name in os.listdir(folder)
+                  if name.endswith(suffix) and not name.startswith("."))
+
+
+class ConvertState:
+    """State file of a run: {"source", "target", "users": {user: result}}.
+    Written atomically after every user, so an interrupted run knows
+    which users are done and which were started."""
+
+    def __init__(self, path, source_backend, target_backend):
+        self._path = path
+        self.users = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as state_file:
+                state = json.load(state_file)
+            if (state.get("source"), state.get("target")) != (source_backend, target_backend):
+                raise ConvertError(f"{path} belongs to a {state.get('source')} -> "
+                                   f"{state.get('target')} run")
+            self.users = state.get("users", {})
+        self._source = source_backend
+        self._target = target_backend
+
+    def status(self, user):
+        """Returns the recorded status of user or None."""
+        return self.users.get(user, {}).get("status")
+
+    def record(self, user, result):
+        """Stores the result of user and writes the file."""
+        self.users[user] = result
+        state = {"source": self._source, "target": self._target, "users": self.users}
+        atomic_write(self._path, lambda state_file: json.dump(state, state_file, indent=4),
+                     encoding="utf-8")
+
+
+def migrate_users(folder, source_backend, target_backend, state_path,
+                  users=None, workers=None, batch_size=BATCH_SIZE, output=sys.stdout):
+    """Converts users (default: every user of source_backend in folder) in
+    a process pool and returns {user: result}. Users marked done in the
+    state file are skipped."""
+    if SUFFIXES[source_backend] == SUFFIXES[target_backend]:
+        raise ConvertError(f"{source_backend} and {target_backend} share the same file")
+    state = ConvertState(state_path, source_backend, target_backend)
+    users = users if users is not None else find_users(folder, source_backend)
+    pending = []
+    for user in users:
+        if state.status(user) == "done":
+            print(f"{user}: already converted", file=output)
+        else:
+            pending.append(user)
+    results = {}
+    with ProcessPoolExecutor(workers) as pool:
+        futures = {}
+        for user in pending:
+            # a user that was started (or failed half way) may have movies in the target
+            resume = state.status(user) in ("started", "failed")
+            state.record(user, {"status": "started"})
+            futures[pool.submit(convert_user, folder, user, source_backend,
+                                target_backend, resume, batch_size)] = user
+        for future in as_completed(futures):
+            user = futures[future]
+            try:
+                result = future.result()
+            except Exception as error:  # a crashed worker fails only its user
+                result = {"user": user, "status": "failed", "error": repr(error)}
+            state.record(user, result)
+            results[user] = result
+            if result["status"] == "done":
+                print(f"{user}: {result['count']} movies in {result['seconds']} s", file=output)
+            else:
+                print(f"{user}: FAILED {result['error']}", file=output)
+    return results
+
+
+def main(argv=None):
+    """Command line entry point."""
+    from movie_user_app import FOLDER_DIR
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    parser.add_argument("--from", dest="source", required=True, choices=sorted(SUFFIXES))
+    parser.add_argument("--to", dest="target", required=True, choices=sorted(SUFFIXES))
+    parser.add_argument("--users", help="comma separated users (default: every user)")
+    parser.add_argument("--folder", default=FOLDER_DIR, help="user storage folder")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes (default: cpu count)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--state",
+                        help="state file (default: <folder>/convert-<from>-<to>.state)")
+    args = parser.parse_args(argv)
+
+    state_path = args.state or os.path.join(
+        args.folder, f"convert-{args.source}-{args.target}.state")
+    users = [user.strip().lower() for user in args.users.split(",")] if args.users else None
+    try:
+        results = migrate_users(args.folder, args.source, args.target, state_path,
+                                users, args.workers, args.batch_size)
+    except (ConvertError, OSError, ValueError) as error:
+        print(f"Conversion aborted\n\t--> {error}", file=sys.stderr)
+        return 2
+    failed = sum(1 for result in results.values() if result["status"] != "done")
+    print(f"{len(results) - failed} users converted, {failed} failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,507 @@
+"""Binary movie storage read and written through mmap.
+
+Layout of <name>.mmap (little endian):
+
+    header   64 bytes   magic, version, counts, capacities, heap use,
+                        generation (bumped on every write) and file id
+    table    table_size x u32      open addressing hash table keyed by the
+                                   crc32 of the title: record slot + 1,
+                                   0 for empty, TOMBSTONE for deleted
+    records  capacity x 32 bytes   heap offset, title/poster/year text
+                                   lengths, flags, year (i32), rating (f64)
+    heap     heap_capacity bytes   utf-8 title, poster and year text of
+                                   every record, one after the other
+
+Opening maps the file and reads the header only. A lookup hashes the
+title and reads one record and its strings; a rating update rewrites the
+8 bytes of the rating in place. When the record table, the hash table or
+the heap is full (or too many records are deleted) the file is rebuilt
+compacted with doubled capacities into a new file that replaces the old
+one. Other processes notice the new inode and map it again."""
+import mmap
+import os
+import secrets
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+from math import isnan
+from istorage import IStorage
+from movie_record import Movie
+from storage import StorageError, MovieExistsError, MovieNotFoundError, FileLock
+
+MAGIC = b"MOVMMAP1"
+VERSION = 1
+# magic, version, count, slots, capacity, table size, dead, heap used,
+# heap capacity, generation, file id
+HEADER = struct.Struct("<8sIIIIIIQQQQ")
+# heap offset, title length, poster length, year text length, flags,
+# year, rating
+RECORD = struct.Struct("<QIIHBxid")
+RATING_OFFSET = 24
+SLOT = struct.Struct("<I")
+TOMBSTONE = 0xFFFFFFFF
+DELETED = 1
+NO_POSTER = 2
+NO_YEAR = 4
+YEAR_TEXT = 8
+UNRATED = float("nan")
+
+
+class _Layout:
+    """Header values of a mapped file and the offsets derived from them."""
+
+    def __init__(self, values):
+        (magic, version, self.count, self.slots, self.capacity, self.table_size,
+         self.dead, self.heap_used, self.heap_capacity, self.generation,
+         self.file_id) = values
+        if magic != MAGIC or version != VERSION:
+            raise StorageError("Not a movie mmap file or an unknown version")
+        self.table_offset = HEADER.size
+        self.records_offset = self.table_offset + self.table_size * SLOT.size
+        self.heap_offset = self.records_offset + self.capacity * RECORD.size
+        self.size = self.heap_offset + self.heap_capacity
+
+    def values(self):
+        return (MAGIC, VERSION, self.count, self.slots, self.capacity, self.table_size,
+                self.dead, self.heap_used, self.heap_capacity, self.generation,
+                self.file_id)
+
+
+def _encode(text):
+    return b"" if text is None else str(text).encode("utf-8")
+
+
+def _heap_size(title, year, poster):
+    """Heap bytes taken by the strings of one movie."""
+    return len(_encode(title)) + len(_encode(poster)) + len(_year_field(year)[2])
+
+
+def _year_field(year):
+    """Returns (flags, year, year text bytes) of a year value."""
+    if year is None:
+        return NO_YEAR, 0, b""
+    text = str(year)
+    if text.isdigit() and str(int(text)) == text and int(text) < 2 ** 31:
+        return 0, int(text), b""
+    return YEAR_TEXT, 0, text.encode("utf-8")
+
+
+def _rating_field(rating):
+    """Ratings are stored as float, anything else (e.g. "N/A") as NaN."""
+    try:
+        return float(rating)
+    except (TypeError, ValueError):
+        return UNRATED
+
+
+def _numpy():
+    """Returns numpy, imported on first use, None when it isn't installed
+    (the statistics loop over the records instead)."""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+class StorageMmap(IStorage):
+    """This class is used to store movies in a memory mapped binary file.
+    Reads take a shared and mutations an exclusive FileLock, threads of
+    one process also share self._lock because a rebuild remaps the file."""
+
+    INITIAL_CAPACITY = 1024
+    INITIAL_HEAP = 64 * 1024
+    MIN_VACUUM_ROWS = 64
+    STREAM_ROWS = 512
+
+    def __init__(self, file_path, vacuum_ratio=0.3):
+        """Recive file path with name without extension"""
+        file_path = file_path + ".mmap"
+        self._file_path = file_path
+        self._vacuum_ratio = vacuum_ratio
+        self._file_lock = FileLock(file_path)
+        self._lock = threading.RLock()
+        self._file = None
+        self._map = None
+        self._inode = None
+        self._deferred = False
+        if not os.path.exists(file_path):
+            with self._file_lock.exclusive():
+                if not os.path.exists(file_path):
+                    self._rebuild([], StorageMmap.INITIAL_CAPACITY,
+                                  StorageMmap.INITIAL_HEAP, secrets.randbits(63), 0)
+
+    # mapping
+
+    def _current(self):
+        """Maps the file again when another process replaced it, returns
+        the layout of the mapped file. Called under self._lock."""
+        inode = os.stat(self._file_path).st_ino
+        if self._map is None or inode != self._inode:
+            self._unmap()
+            self._file = open(self._file_path, "r+b")
+            try:
+                self._map = mmap.mmap(self._file.fileno(), 0)
+            except ValueError as error:
+                raise StorageError(f"Can't map {self._file_path}:\n\t--> {error}") from error
+            self._inode = os.fstat(self._file.fileno()).st_ino
+        try:
+            layout = _Layout(HEADER.unpack_from(self._map, 0))
+        except struct.error as error:
+            raise StorageError(f"Truncated mmap file {self._file_path}") from error
+        if layout.size > len(self._map):
+            raise StorageError(f"Truncated mmap file {self._file_path}")
+        return layout
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+            self._map = self._file = None
+
+    @contextmanager
+    def _reading(self):
+        """Holds the shared file lock and the mapping, yields the layout."""
+        with self._file_lock.shared(), self._lock:
+            yield self._current()
+
+    @contextmanager
+    def _writing(self):
+        """Holds the exclusive file lock and the mapping, yields the layout
+        and writes the header (one more generation) back at the end, also
+        after an error: every change applied so far is complete."""
+        with self._file_lock.exclusive(), self._lock:
+            layout = self._current()
+            try:
+                yield layout
+            finally:
+                if self._map is not None:
+                    layout.generation += 1
+                    HEADER.pack_into(self._map, 0, *layout.values())
+                    if not self._deferred:
+                        self._map.flush()
+
+    def _write_lock(self):
+        """Other processes wait while a mutation changes the file."""
+        return self._file_lock.exclusive()
+
+    def _read_lock(self):
+        """Readers share the file lock."""
+        return self._file_lock.shared()
+
+    @contextmanager
+    def deferred_writes(self):
+        """Holds the exclusive lock for the block and syncs the file to
+        disk once at its end instead of after every change."""
+        if self._deferred:
+            yield self
+            return
+        with self._file_lock.exclusive():
+            self._deferred = True
+            try:
+                yield self
+            finally:
+                self._deferred = False
+                with self._lock:
+                    if self._map is not None:
+                        self._map.flush()
+
+    def signature(self):
+        """File id and generation of the header, written on every change."""
+        with self._reading() as layout:
+            return layout.file_id, layout.generation
+
+    def sidecar_path(self, suffix):
+        """Derived files sit next to the mmap file."""
+        return self._file_path + suffix
+
+    def close(self):
+        """Unmaps the file and closes the lock file descriptors."""
+        with self._lock:
+            self._unmap()
+            self._file_lock.close()
+
+    # records
+
+    def _record(self, layout, slot):
+        """Returns (flags, title, year, rating, poster) of a record slot,
+        only the flags of a deleted one."""
+        offset, title_length, poster_length, year_length, flags, year, rating = \
+            RECORD.unpack_from(self._map, layout.records_offset + slot * RECORD.size)
+        if flags & DELETED:
+            return flags, None, None, None, None
+        start = layout.heap_offset + offset
+        title = self._map[start:start + title_length].decode("utf-8")
+        start += title_length
+        poster = None
+        if not flags & NO_POSTER:
+            poster = self._map[start:start + poster_length].decode("utf-8")
+        start += poster_length
+        if flags & NO_YEAR:
+            year = None
+        elif flags & YEAR_TEXT:
+            year = self._map[start:start + year_length].decode("utf-8")
+        return flags, title, year, rating, poster
+
+    @staticmethod
+    def _to_movie(year, rating, poster):
+        """Converts record fields to a movie dictionary."""
+        return {"Year": None if year is None else str(year),
+                "imdbRating": "N/A" if isnan(rating) else rating, "Poster": poster}
+
+    def _find(self, layout, title):
+        """Returns (table position, record slot) of title, the slot is None
+        when it isn't stored and the position is where it would go."""
+        encoded = title.encode("utf-8")
+        mask = layout.table_size - 1
+        position = zlib.crc32(encoded) & mask
+        free = None
+        while True:
+            entry = SLOT.unpack_from(self._map, layout.table_offset + position * SLOT.size)[0]
+            if entry == 0:
+                return (position if free is None else free), None
+            if entry == TOMBSTONE:
+                if free is None:
+                    free = position
+            else:
+                record = layout.records_offset + (entry - 1) * RECORD.size
+                offset, title_length = RECORD.unpack_from(self._map, record)[:2]
+                start = layout.heap_offset + offset
+                if title_length == len(encoded) and \
+                        self._map[start:start + title_length] == encoded:
+                    return position, entry - 1
+            position = (position + 1) & mask
+
+    def _append(self, layout, position, title, year, rating, poster):
+        """Writes a new record and its strings, links it at table position."""
+        encoded_title = title.encode("utf-8")
+        encoded_poster = _encode(poster)
+        year_flags, year_value, year_text = _year_field(year)
+        flags = year_flags | (NO_POSTER if poster is None else 0)
+        start = layout.heap_offset + layout.heap_used
+        data = encoded_title + encoded_poster + year_text
+        self._map[start:start + len(data)] = data
+        RECORD.pack_into(self._map, layout.records_offset + layout.slots * RECORD.size,
+                         layout.heap_used, len(encoded_title), len(encoded_poster),
+                         len(year_text), flags, year_value, _rating_field(rating))
+        SLOT.pack_into(self._map, layout.table_offset + position * SLOT.size, layout.slots + 1)
+        layout.heap_used += len(data)
+        layout.slots += 1
+        layout.count += 1
+
+    def _live(self, layout, start=0, stop=None):
+        """Yields (slot, title, year, rating, poster) of the stored movies
+        in slot order from start."""
+        stop = layout.slots if stop is None else min(stop, layout.slots)
+        for slot in range(start, stop):
+            flags, title, year, rating, poster = self._record(layout, slot)
+            if not flags & DELETED:
+                yield slot, title, year, rating, poster
+
+    def _rebuild(self, movies, capacity, heap_capacity, file_id, generation):
+        """Writes a new file holding movies ((title, year, rating, poster)
+        tuples) with the given capacities and maps it. The records are
+        appended with the helpers of the mapped file, pointed to the new
+        map meanwhile."""
+        table_size = 1
+        while table_size < capacity * 2:
+            table_size *= 2
+        layout = _Layout((MAGIC, VERSION, 0, 0, capacity, table_size, 0, 0,
+                          heap_capacity, generation, file_id))
+        temp_path = f"{self._file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, "w+b") as new_file:
+                new_file.truncate(layout.size)
+                new_map = mmap.mmap(new_file.fileno(), 0)
+                try:
+                    with self._lock:
+                        old_map, self._map = self._map, new_map
+                        try:
+                            for title, year, rating, poster in movies:
+                                position = self._find(layout, title)[0]
+                                self._append(layout, position, title, year, rating, poster)
+                        finally:
+                            self._map = old_map
+                    HEADER.pack_into(new_map, 0, *layout.values())
+                    new_map.flush()
+                finally:
+                    new_map.close()
+                os.fsync(new_file.fileno())
+            with self._lock:
+                self._unmap()
+                os.replace(temp_path, self._file_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _grow(self, layout, records=0, heap_bytes=0, compact=False):
+        """Rebuilds the file without the deleted records when records more
+        movies and heap_bytes more string bytes don't fit (or compact is
+        set), with room for twice the live data. Returns the layout to
+        continue with."""
+        if not compact and layout.slots + records <= layout.capacity and \
+                layout.heap_used + heap_bytes <= layout.heap_capacity:
+            return layout
+        movies = [(title, year, "N/A" if isnan(rating) else rating, poster)
+                  for _, title, year, rating, poster in self._live(layout)]
+        live_heap = sum(_heap_size(title, year, poster) for title, year, _, poster in movies)
+        capacity = StorageMmap.INITIAL_CAPACITY
+        while capacity < (len(movies) + records) * 2:
+            capacity *= 2
+        heap_capacity = StorageMmap.INITIAL_HEAP
+        while heap_capacity < (live_heap + heap_bytes) * 2:
+            heap_capacity *= 2
+        self._rebuild(movies, capacity, heap_capacity, layout.file_id, layout.generation)
+        return self._current()
+
+    # IStorage
+
+    def list_movies(self):
+        """list_movies is a method that returns a dictionary."""
+        with self._reading() as layout:
+            return {title: self._to_movie(year, rating, poster)
+                    for _, title, year, rating, poster in self._live(layout)}
+
+    def iter_movies(self):
+        """Yields (title, info) pairs, STREAM_ROWS records at a time under
+        the shared lock. After a rebuild by another writer it continues
+        behind the last title it yielded (rebuilds keep the order)."""
+        start = 0
+        last_title = inode = None
+        while True:
+            with self._reading() as layout:
+                if last_title is not None and self._inode != inode:
+                    slot = self._find(layout, last_title)[1]
+                    if slot is None:
+                        raise StorageError("Movies changed while they were read")
+                    start = slot + 1
+                inode = self._inode
+                block = list(self._live(layout, start, start + StorageMmap.STREAM_ROWS))
+                done = start + StorageMmap.STREAM_ROWS >= layout.slots
+            for _, title, year, rating, poster in block:
+                yield title, self._to_movie(year, rating, poster)
+            if block:
+                last_title = block[-1][1]
+            if done:
+                return
+            start += StorageMmap.STREAM_ROWS
+
+    def list_records(self):
+        """Builds the records straight from the record table."""
+        with self._reading() as layout:
+            return [Movie(title, year, None if isnan(rating) else rating, poster)
+                    for _, title, year, rating, poster in self._live(layout)]
+
+    def get_movie(self, title):
+        """Returns the movie info of title or None (one hash lookup)."""
+        with self._reading() as layout:
+            slot = self._find(layout, title)[1]
+            if slot is None:
+                return None
+            _, _, year, rating, poster = self._record(layout, slot)
+            return self._to_movie(year, rating, poster)
+
+    def add_movie(self, title, year, rating, poster):
+        """Appends a movie to the record table."""
+        with self._writing() as layout:
+            position, slot = self._find(layout, title)
+            if slot is not None:
+                raise MovieExistsError("Movie already exists in mmap file")
+            grown = self._grow(layout, 1, _heap_size(title, year, poster))
+            if grown is not layout:
+                layout.__dict__.update(grown.__dict__)
+                position = self._find(layout, title)[0]
+            self._append(layout, position, title, year, rating, poster)
+
+    def add_movies(self, movies):
+        """Appends a batch of movies, growing the file at most once.
+        Returns the skipped titles."""
+        movies = list(movies)
+        skipped = []
+        with self._writing() as layout:
+            size = sum(_heap_size(title, year, poster) for title, year, _, poster in movies)
+            layout.__dict__.update(self._grow(layout, len(movies), size).__dict__)
+            for title, year, rating, poster in movies:
+                position, slot = self._find(layout, title)
+                if slot is not None:
+                    skipped.append(title)
+                    continue
+                self._append(layout, position, title, year, rating, poster)
+        return skipped
+
+    def delete_movie(self, title):
+        """Marks the record deleted and leaves a tombstone in the table.
+        The file is compacted once vacuum_ratio of the records are dead."""
+        with self._writing() as layout:
+            position, slot = self._find(layout, title)
+            if slot is None:
+                raise MovieNotFoundError("Movie doesn't exist in mmap file")
+            record = layout.records_offset + slot * RECORD.size
+            flags = RECORD.unpack_from(self._map, record)[4]
+            struct.pack_into("<B", self._map, record + 18, flags | DELETED)
+            SLOT.pack_into(self._map, layout.table_offset + position * SLOT.size, TOMBSTONE)
+            layout.count -= 1
+            layout.dead += 1
+            if layout.dead >= StorageMmap.MIN_VACUUM_ROWS and \
+                    layout.dead > self._vacuum_ratio * layout.slots:
+                layout.__dict__.update(self._grow(layout, compact=True).__dict__)
+
+    def update_movie(self, title, rating):
+        """Rewrites the rating of a movie in place."""
+        with self._writing() as layout:
+            slot = self._find(layout, title)[1]
+            if slot is None:
+                raise MovieNotFoundError("Movie doesn't exist in mmap file")
+            struct.pack_into("<d", self._map,
+                             layout.records_offset + slot * RECORD.size + RATING_OFFSET,
+                             _rating_field(rating))
+
+    def vacuum(self):
+        """Rebuilds the file without the deleted records."""
+        with self._writing() as layout:
+            layout.__dict__.update(self._grow(layout, compact=True).__dict__)
+
+    def _ratings(self, layout):
+        """Ratings of the stored, rated movies read from the record table
+        without touching the heap."""
+        numpy = _numpy()
+        if numpy is not None:
+            records = numpy.frombuffer(self._map, dtype=numpy.dtype(
+                [("head", "<u8", 3), ("rating", "<f8")]), count=layout.slots,
+                offset=layout.records_offset)
+            flags = numpy.frombuffer(self._map, dtype=numpy.uint8, count=layout.slots * 32,
+                                     offset=layout.records_offset)[18::RECORD.size]
+            ratings = records["rating"][(flags & DELETED) == 0]
+            ratings = ratings[~numpy.isnan(ratings)].copy()
+            del records, flags
+            return ratings
+        ratings = []
+        with memoryview(self._map) as view:
+            table = view[layout.records_offset:layout.records_offset + layout.slots * RECORD.size]
+            for fields in RECORD.iter_unpack(table):
+                if not fields[4] & DELETED and not isnan(fields[6]):
+                    ratings.append(fields[6])
+            table.release()
+        return ratings
+
+    def rating_stats(self):
+        """Returns count, max, min, average and median of imdbRating read
+        from the fixed width record table."""
+        with self._reading() as layout:
+            ratings = self._ratings(layout)
+        count = len(ratings)
+        if not count:
+            return {"count": 0, "max": None, "min": None, "average": None, "median": None}
+        middle = (count - 1) // 2
+        numpy = _numpy()
+        if numpy is not None:
+            median = float(numpy.partition(ratings, middle)[middle])
+            return {"count": count, "max": float(ratings.max()), "min": float(ratings.min()),
+                    "average": float(ratings.sum()) / count, "median": median}
+        ratings.sort()
+        return {"count": count, "max": ratings[-1], "min": ratings[0],
+                "average": sum(ratings) / count, "median": ratings[middle]}
+
+    def __str__(self):
+        return "\n".join(f"{title}: {info}" for title, info in self.iter_movies())
@@ -0,0 +1,78 @@
+"""Tests of the incremental views of movie_views.
+
+    python -m unittest test_movie_views
+"""
+import shutil
+import tempfile
+import unittest
+from movie_views import RatingIndex, RatingStats, UNRATED, parse_rating
+from storage import StorageJson
+
+
+class MovieViewTestCase(unittest.TestCase):
+    """Gives every test a json storage in a temporary folder."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix="movie-views-")
+        self.storage = StorageJson(f"{self.folder}/library")
+        self.storage.add_movies([("A", "2001", 7.26, "N/A"), ("B", "2002", 3.04, "N/A"),
+                                 ("C", "2003", 5.5, "N/A"), ("D", "2004", "N/A", "N/A")])
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+class ParseRatingTest(unittest.TestCase):
+    """parse_rating keeps only finite numbers."""
+
+    def test_non_finite_is_unrated(self):
+        for rating in ("N/A", None, "nan", float("nan"), float("inf"), "-inf"):
+            self.assertEqual(parse_rating(rating), UNRATED)
+        self.assertEqual(parse_rating("7.5"), 7.5)
+
+
+class RatingIndexTest(MovieViewTestCase):
+    """RatingIndex stays ordered when a rating isn't a number."""
+
+    def test_nan_rating_keeps_order(self):
+        index = self.storage.view(RatingIndex)
+        self.assertEqual([title for title, _ in index.top(4)], ["A", "C", "B", "D"])
+        self.storage.update_movie("C", float("nan"))
+        self.assertEqual([title for title, _ in index.top(4)], ["A", "B", "D", "C"])
+        self.assertEqual([title for title, _ in index.between(3, 8)], ["B", "A"])
+        self.storage.update_movie("C", 6.0)
+        self.assertEqual([title for title, _ in index.between(5, 8)], ["C", "A"])
+
+
+class RatingStatsTest(MovieViewTestCase):
+    """RatingStats reports the stored ratings exactly."""
+
+    def test_exact_summary(self):
+        summary = self.storage.view(RatingStats).summary()
+        self.assertEqual((summary["count"], summary["max"], summary["min"], summary["median"]),
+                         (3, 7.26, 3.04, 5.5))
+
+    def test_non_finite_rating_is_left_out(self):
+        stats = self.storage.view(RatingStats)
+        stats.summary()
+        for rating in (float("nan"), float("inf")):
+            self.storage.update_movie("A", rating)
+            summary = stats.summary()
+            self.assertEqual((summary["count"], summary["max"], summary["min"]), (2, 5.5, 3.04))
+        self.storage.update_movie("A", 9.9)
+        self.assertEqual(stats.summary()["max"], 9.9)
+
+
+class MovieAppRatingTest(MovieViewTestCase):
+    """MovieApp rejects non-finite ratings before writing."""
+
+    def test_update_rejects_nan(self):
+        from movie_user_app import AppError, MovieApp
+        app = MovieApp(self.storage)
+        with self.assertRaises(AppError):
+            app.update_movie("A", float("nan"))
+        self.assertEqual(self.storage.get_movie("A")["imdbRating"], 7.26)
+
+
+if __name__ == "__main__":
+    unittest.main()
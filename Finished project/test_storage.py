@@ -0,0 +1,41 @@
+"""Tests that every storage backend answers alike.
+
+    python -m unittest test_storage
+"""
+import shutil
+import tempfile
+import unittest
+from movie_user_app import get_user_storage
+
+BACKENDS = ("json", "journal", "csv", "sqlite", "mmap")
+
+
+class UnratedMovieTest(unittest.TestCase):
+    """An unrated movie reads back as "N/A" from every backend."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix="movie-storage-")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_unrated_movie(self):
+        for backend in BACKENDS:
+            with self.subTest(backend=backend):
+                storage = get_user_storage(backend, f"{self.folder}/{backend}")
+                storage.add_movies([("Rated", "2001", 7.5, "N/A"),
+                                    ("Unrated", "2002", "N/A", "N/A")])
+                storage.add_movie("Later", "2003", "N/A", "N/A")
+                for title in ("Unrated", "Later"):
+                    self.assertEqual(storage.get_movie(title)["imdbRating"], "N/A")
+                    self.assertEqual(storage.list_movies()[title]["imdbRating"], "N/A")
+                self.assertEqual(dict(storage.iter_movies())["Unrated"]["imdbRating"], "N/A")
+                self.assertEqual(dict(storage.sort_movies())["Unrated"]["imdbRating"], "N/A")
+                records = {record.title: record for record in storage.list_records()}
+                self.assertEqual(records["Unrated"]["imdbRating"], "N/A")
+                self.assertEqual(storage.rating_stats()["count"], 1)
+                storage.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,239 @@
+"""Fuzzy and prefix title search over the stored titles.
+
+Titles are normalized (case, accents, punctuation, a leading or trailing
+article: "Matrix, The" and "the matrix" are both "matrix") and split in
+trigrams. TitleIndex keeps an inverted index trigram -> title ids next to
+a sorted list of the normalized titles, so a query only looks at titles
+sharing its rarest trigrams or its prefix. The index is a MovieView, it
+follows every add and delete and is saved next to the storage file."""
+import atexit
+import json
+import os
+import re
+import unicodedata
+import weakref
+from bisect import bisect_left, insort
+from collections import Counter
+from math import ceil
+from movie_views import MovieView
+from storage import atomic_write
+
+ARTICLES = ("the", "a", "an")
+_TRAILING_ARTICLE = re.compile(r",\s*(the|an?)\s*$")
+_WORDS = re.compile(r"[^\W_]+")
+# indexes with changes that aren't saved yet, written on exit
+_unsaved = weakref.WeakSet()
+
+
+def normalize(title):
+    """Returns the search key of a title."""
+    text = str(title).lower()
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+        text = "".join(character for character in text if not unicodedata.combining(character))
+    text = _TRAILING_ARTICLE.sub("", text.strip())
+    words = _WORDS.findall(text)
+    if len(words) > 1 and words[0] in ARTICLES:
+        words = words[1:]
+    return " ".join(words)
+
+
+def trigrams(key):
+    """Returns the set of trigrams of a search key, padded so the start
+    of the key weighs more."""
+    padded = f"  {key} "
+    return {padded[position:position + 3] for position in range(len(padded) - 2)}
+
+
+class TitleIndex(MovieView):
+    """Trigram inverted index of the titles of one storage.
+    search() ranks by the Dice coefficient of the trigram sets, exact
+    normalized matches score 1 and prefix matches at least PREFIX_SCORE.
+    find() returns the stored title with the same search key."""
+
+    PREFIX_SCORE = 0.6
+    SKIPPED_LISTS = 2
+    VERSION = 1
+
+    def __init__(self, storage):
+        super().__init__(storage)
+        self._path = storage.sidecar_path(".titles")
+        self._saved_signature = None
+
+    def reset(self):
+        self._titles = []
+        self._gram_counts = []
+        self._ids = {}
+        self._free = []
+        self._postings = {}
+        self._keys = {}
+        self._sorted = []
+
+    def add(self, title, info):
+        if title in self._ids:
+            return
+        key = normalize(title)
+        grams = trigrams(key)
+        if self._free:
+            title_id = self._free.pop()
+            self._titles[title_id] = title
+            self._gram_counts[title_id] = len(grams)
+        else:
+            title_id = len(self._titles)
+            self._titles.append(title)
+            self._gram_counts.append(len(grams))
+        self._ids[title] = title_id
+        for gram in grams:
+            self._postings.setdefault(gram, set()).add(title_id)
+        self._keys.setdefault(key, set()).add(title)
+        if self._built:
+            insort(self._sorted, (key, title))
+            _unsaved.add(self)
+        else:  # a rebuild sorts once at the end and saves
+            self._sorted.append((key, title))
+
+    def remove(self, title):
+        title_id = self._ids.pop(title, None)
+        if title_id is None:
+            return
+        key = normalize(title)
+        for gram in trigrams(key):
+            postings = self._postings.get(gram)
+            postings.discard(title_id)
+            if not postings:
+                del self._postings[gram]
+        self._keys[key].discard(title)
+        if not self._keys[key]:
+            del self._keys[key]
+        del self._sorted[bisect_left(self._sorted, (key, title))]
+        self._titles[title_id] = None
+        self._free.append(title_id)
+        _unsaved.add(self)
+
+    def update(self, title, changes):
+        """Ratings don't change titles."""
+
+    def refresh(self):
+        """Loads the saved index when it matches the storage, otherwise
+        rebuilds it from the storage and saves it."""
+        with self._reading():
+            signature = self._storage.signature()
+            if self._built and signature == self._signature:
+                return
+            if not self._built and self._load(signature):
+                return
+            super().refresh()
+            self._sorted.sort()
+            self.save()
+
+    def _load(self, signature):
+        """Reads the saved index, returns False when it is missing or was
+        saved for other data."""
+        if self._path is None or signature is None or not os.path.exists(self._path):
+            return False
+        try:
+            with open(self._path, "r", encoding="utf-8") as index_file:
+                saved = json.load(index_file)
+        except (OSError, ValueError):
+            return False
+        if saved.get("version") != TitleIndex.VERSION or \
+                saved.get("signature") != json.loads(json.dumps(signature)):
+            return False
+        self.reset()
+        self._titles = saved["titles"]
+        self._gram_counts = saved["gram_counts"]
+        self._postings = {gram: set(ids) for gram, ids in saved["postings"].items()}
+        for title_id, (title, key) in enumerate(zip(self._titles, saved["keys"])):
+            if title is None:
+                self._free.append(title_id)
+                continue
+            self._ids[title] = title_id
+            self._keys.setdefault(key, set()).add(title)
+            self._sorted.append((key, title))
+        self._sorted.sort()
+        self._built = True
+        self._signature = self._saved_signature = signature
+        return True
+
+    def save(self):
+        """Writes the index next to the storage file (backends without a
+        stable file signature keep it in memory only)."""
+        with self._lock:
+            if self._path is None or not self._built or self._signature is None or \
+                    self._signature == self._saved_signature:
+                return
+            keys = {title: key for key, title in self._sorted}
+            saved = {"version": TitleIndex.VERSION, "signature": self._signature,
+                     "titles": self._titles, "gram_counts": self._gram_counts,
+                     "keys": [keys.get(title) for title in self._titles],
+                     "postings": {gram: sorted(ids) for gram, ids in self._postings.items()}}
+            atomic_write(self._path, lambda index_file: index_file.write(json.dumps(saved)),
+                         encoding="utf-8")
+            self._saved_signature = self._signature
+            _unsaved.discard(self)
+
+    def find(self, title):
+        """Returns a stored title with the same search key as title, None
+        when there is none."""
+        with self._reading():
+            self.refresh()
+            titles = self._keys.get(normalize(title))
+            return min(titles) if titles else None
+
+    def search(self, query, limit=10, min_score=0.45):
+        """Returns up to limit (title, score) pairs, best first. The
+        default min_score (Dice) is about a trigram Jaccard similarity of 0.3."""
+        key = normalize(query)
+        if not key:
+            return []
+        grams = trigrams(key)
+        with self._reading():
+            self.refresh()
+            scores = {title: 1.0 for title in self._keys.get(key, ())}
+            position = bisect_left(self._sorted, (key,))
+            while position < len(self._sorted) and len(scores) < limit * 2:
+                stored_key, title = self._sorted[position]
+                if not stored_key.startswith(key):
+                    break
+                scores.setdefault(title, max(
+                    TitleIndex.PREFIX_SCORE, 2 * len(grams) / (
+                        len(grams) + self._gram_counts[self._ids[title]])))
+                position += 1
+            for title_id, score in self._similar(grams, min_score):
+                title = self._titles[title_id]
+                if score > scores.get(title, 0):
+                    scores[title] = score
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+            return ranked[:limit]
+
+    def _similar(self, grams, min_score):
+        """Yields (title id, Dice score) of the titles scoring at least
+        min_score against the trigram set grams."""
+        count = len(grams)
+        postings = sorted((self._postings.get(gram, ()) for gram in grams), key=len)
+        # a title scoring min_score shares at least needed trigrams with the
+        # query: counting every list but the largest ones (which would add
+        # most of the candidates), a title must already share needed - skipped
+        needed = max(1, ceil(min_score * count / (2 - min_score) - 1e-9))
+        skipped = min(TitleIndex.SKIPPED_LISTS, needed - 1)
+        shared = Counter()
+        for posting in postings[:count - skipped]:
+            shared.update(posting)
+        largest = postings[count - skipped:]
+        for title_id, common in shared.items():
+            if common < needed - skipped:
+                continue
+            common += sum(1 for posting in largest if title_id in posting)
+            score = 2 * common / (count + self._gram_counts[title_id])
+            if score >= min_score:
+                yield title_id, score
+
+
+@atexit.register
+def _save_unsaved():
+    """Saves the indexes changed since they were last written."""
+    for index in list(_unsaved):
+        try:
+            index.save()
+        except OSError:
+            pass
@@ -0,0 +1,247 @@
+"""Indexed store of the registered users and their salted password hashes.
+
+    python user_registry.py migrate registry
+    python user_registry.py provision users.csv
+
+All users live in one sqlite file (registry/users.sqlite3) keyed by user
+name, so a login is one indexed lookup instead of a folder per user.
+Passwords are kept as PBKDF2-HMAC-SHA256 hashes with a random salt per
+user. migrate imports the old registry/<user>/registry.json folders once,
+provision adds "username,password" rows of a csv file in bulk."""
+import csv
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+HASH_NAME = "sha256"
+ITERATIONS = 200000
+SALT_BYTES = 16
+PROVISION_WORKERS = 8
+# seconds a successful password check is reused without hashing again
+VERIFY_TTL = 300
+
+
+class RegistryError(Exception):
+    """RegistryError is a class for raising errors."""
+
+    def __init__(self, message: str) -> None:
+        super().__init__(message)
+
+
+def normalize(username):
+    """User names are stored stripped and lower case."""
+    return username.strip().lower()
+
+
+def hash_password(password, salt, iterations=ITERATIONS):
+    """Returns the PBKDF2 hash of password."""
+    return hashlib.pbkdf2_hmac(HASH_NAME, password.encode("utf-8"), salt, iterations)
+
+
+class UserRegistry:
+    """sqlite table of (username, salt, hash, iterations) with an in
+    memory LRU layer of the records, so repeated logins of the same user
+    don't query the database. Unknown names are never cached, users
+    added by another process are found on the next lookup.
+    A successful verify() is remembered for verify_ttl seconds as an HMAC
+    of the user and password under a per process key, so a client sending
+    its password with every request pays the PBKDF2 cost once per ttl."""
+
+    def __init__(self, file_path, iterations=ITERATIONS, memory_entries=4096,
+                 verify_ttl=VERIFY_TTL):
+        folder = os.path.dirname(file_path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        self._iterations = iterations
+        self._memory_entries = memory_entries
+        self._memory = OrderedDict()
+        self._verify_ttl = verify_ttl
+        self._verified = OrderedDict()
+        self._verify_key = secrets.token_bytes(32)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(file_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                "username TEXT PRIMARY KEY, salt BLOB NOT NULL, hash BLOB NOT NULL, "
+                "iterations INTEGER NOT NULL, created REAL NOT NULL) WITHOUT ROWID")
+
+    def _remember(self, username, record):
+        """Keeps record in the in memory layer."""
+        self._memory[username] = record
+        self._memory.move_to_end(username)
+        while len(self._memory) > self._memory_entries:
+            self._memory.popitem(last=False)
+
+    def _record(self, username):
+        """Returns (salt, hash, iterations) of username or None."""
+        with self._lock:
+            record = self._memory.get(username)
+            if record is None:
+                record = self._connection.execute(
+                    "SELECT salt, hash, iterations FROM users WHERE username = ?",
+                    (username,)).fetchone()
+            if record is not None:
+                self._remember(username, record)
+            return record
+
+    def _new_record(self, password):
+        """Hashes password with a fresh salt."""
+        salt = secrets.token_bytes(SALT_BYTES)
+        return salt, hash_password(password, salt, self._iterations), self._iterations
+
+    def exists(self, username):
+        """Checks whether username is registered."""
+        return self._record(normalize(username)) is not None
+
+    def verify(self, username, password):
+        """Checks password of username, raises RegistryError when the
+        user isn't registered."""
+        username = normalize(username)
+        record = self._record(username)
+        if record is None:
+            raise RegistryError("User is not registered!! Aborted")
+        salt, stored_hash, iterations = record
+        proof = hmac.new(self._verify_key, f"{username}\0{password}".encode("utf-8"),
+                         HASH_NAME).digest()
+        now = time.monotonic()
+        with self._lock:
+            verified = self._verified.get(username)
+        if verified is not None and verified[1] > now and verified[2] == stored_hash and \
+                hmac.compare_digest(verified[0], proof):
+            return True
+        if not hmac.compare_digest(hash_password(password, salt, iterations), stored_hash):
+            return False
+        with self._lock:
+            self._verified[username] = (proof, now + self._verify_ttl, stored_hash)
+            self._verified.move_to_end(username)
+            while len(self._verified) > self._memory_entries:
+                self._verified.popitem(last=False)
+        return True
+
+    def add_user(self, username, password):
+        """Registers a user, raises RegistryError when the name is taken."""
+        username = normalize(username)
+        if not username:
+            raise RegistryError("User name is empty")
+        if self.add_users([(username, password)]):
+            raise RegistryError("User is already registered!! Aborted")
+
+    def add_users(self, users, workers=PROVISION_WORKERS):
+        """Registers (username, password) pairs in one transaction and
+        returns the names that were skipped because they already exist
+        (or came twice). Hashing runs in a thread pool, hashlib releases
+        the GIL while it works."""
+        names, passwords, skipped, seen = [], [], [], set()
+        for username, password in users:
+            username = normalize(username)
+            if not username:
+                continue
+            if username in seen:
+                skipped.append(username)
+                continue
+            seen.add(username)
+            names.append(username)
+            passwords.append(password)
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max(1, workers)) as pool:
+            records = list(pool.map(self._new_record, passwords))
+        now = time.time()
+        with self._lock:
+            with self._connection:
+                for username, record in zip(names, records):
+                    try:
+                        self._connection.execute(
+                            "INSERT INTO users VALUES (?, ?, ?, ?, ?)",
+                            (username, *record, now))
+                    except sqlite3.IntegrityError:
+                        skipped.append(username)
+                        continue
+                    self._remember(username, record)
+        return skipped
+
+    def migrate_folders(self, folder):
+        """Imports the old folder layout (folder/<user>/registry.json with a
+        plain text password) once. Migrated files are removed, their folder
+        too when it's empty. Returns the number of migrated users."""
+        if not os.path.isdir(folder):
+            return 0
+        users, paths = [], []
+        for entry in os.scandir(folder):
+            path = os.path.join(entry.path, "registry.json")
+            if not entry.is_dir() or not os.path.isfile(path):
+                continue
+            try:
+                with open(path, "r", encoding="utf-8") as registry:
+                    user_data = json.load(registry)
+                users.append((user_data.get("username") or entry.name, user_data["password"]))
+            except (OSError, ValueError, KeyError) as error:
+                raise RegistryError(f"Can't migrate {path}:\n\t--> {error}") from error
+            paths.append(path)
+        skipped = self.add_users(users)
+        for path in paths:
+            os.remove(path)
+            if not os.listdir(os.path.dirname(path)):
+                os.rmdir(os.path.dirname(path))
+        return len(users) - len(skipped)
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def close(self):
+        """Closes the database."""
+        with self._lock:
+            self._connection.close()
+
+
+def provision_file(registry, file_path):
+    """Adds the "username,password" rows of a csv file, returns
+    (added, skipped names)."""
+    with open(file_path, "r", newline="", encoding="utf-8") as users_file:
+        users = [(row[0], row[1]) for row in csv.reader(users_file)
+                 if len(row) >= 2 and row[0].strip()]
+    skipped = registry.add_users(users)
+    return len(users) - len(skipped), skipped
+
+
+def main():
+    """Command line entry point."""
+    import argparse
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    parser.add_argument("--registry", help="registry database (default: the app's)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate = commands.add_parser("migrate", help="import the old per user folders")
+    migrate.add_argument("folder", nargs="?", help="old registry folder (default: the app's)")
+    provision = commands.add_parser("provision", help="add users from a csv file")
+    provision.add_argument("file", help="csv file with username,password rows")
+    args = parser.parse_args()
+
+    from movie_user_app import UserShell
+    registry = (UserRegistry(args.registry) if args.registry
+                else UserShell.user_registry())
+    try:
+        if args.command == "migrate":
+            count = registry.migrate_folders(args.folder or UserShell.registry_dir())
+            print(f"Migrated {count} users")
+        else:
+            added, skipped = provision_file(registry, args.file)
+            print(f"Added {added} users")
+            if skipped:
+                print("Already registered: " + ", ".join(skipped))
+    except (RegistryError, OSError) as error:
+        parser.exit(1, f"{error}\n")
+
+
+if __name__ == "__main__":
+    main()